@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# The latency of a check when keepalived starts a new check_haproxy each interval (cold), against a check made by the
+# long-lived --check-daemon over a kept-alive session (warm), and the check_state script keepalived runs instead.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import requests
+from common import scripts_path, timed, report, HTTPStandIn
+import check_haproxy
+
+def main():
+    print 'Check latency, cold start against warm'
+    stand_in = HTTPStandIn()
+    directory = tempfile.mkdtemp()
+    try:
+        check_haproxy_path = os.path.join(scripts_path,'check_haproxy.py')
+        runs = 20
+        seconds = timed(lambda: [subprocess.call([sys.executable,check_haproxy_path,stand_in.url])
+                                 for _ in range(runs)],1)
+        report('cold, a new check_haproxy process',seconds / runs * 1000,'ms')
+
+        sessions = { stand_in.url : requests.Session() }
+        check_haproxy.check(sessions,2,1,set([200]),None) # Open the connection
+        runs = 500
+        seconds = timed(lambda: [check_haproxy.check(sessions,2,1,set([200]),None) for _ in range(runs)],1)
+        report('warm, a check by the daemon over a kept-alive session',seconds / runs * 1000,'ms')
+
+        state_file = os.path.join(directory,'check.state')
+        check_haproxy.publish(state_file,0,0.001,100)
+        check_state_path = os.path.join(scripts_path,'check_state.sh')
+        runs = 100
+        seconds = timed(lambda: [subprocess.call(['sh',check_state_path,state_file,'6']) for _ in range(runs)],1)
+        report('check_state, what keepalived runs with the daemon',seconds / runs * 1000,'ms')
+    finally:
+        stand_in.stop()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
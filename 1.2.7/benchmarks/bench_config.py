@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# How long a --config file with hundreds of instances and tens of thousands of VIPs takes to load, validate and render.
+import json
+import os
+import shutil
+import tempfile
+import yaml
+from common import timed, report, write_config, configure, render
+
+def main():
+    print 'Configuration files with 10k+ VIPs'
+    directory = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(directory,'keepalived.json')
+        yaml_path = os.path.join(directory,'keepalived.yaml')
+        output_path = os.path.join(directory,'keepalived.conf')
+        for instances, vips in ((250, 10000), (500, 50000)):
+            write_config(json_path,instances,vips // instances)
+            with open(json_path) as f:
+                config = json.load(f)
+            with open(yaml_path,'w') as f:
+                yaml.safe_dump(config,f)
+            name = '%d VIPs over %d instances' % (vips, instances)
+            report('%s, validate JSON' % name,timed(lambda: configure(['--config',json_path])),'s')
+            report('%s, validate YAML' % name,timed(lambda: configure(['--config',yaml_path]),1),'s')
+            context = configure(['--config',json_path])
+            report('%s, render' % name,timed(lambda: render(context,output_path)),'s')
+            report('%s, rendered size' % name,os.path.getsize(output_path) / 1e6,'MB')
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
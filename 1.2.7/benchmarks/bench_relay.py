@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# How fast keepalived's output is relayed, from the stub keepalived writing lines as fast as it can, in each log
+# format, with and without metrics, and against the line by line relay LogRelay replaced.
+import os
+import sys
+import time
+from subprocess import Popen, PIPE, STDOUT
+from common import entry, stubs_path, report, Quiet
+
+stub_keepalived = os.path.join(stubs_path,'keepalived')
+
+def relay(lines,log_format='plain',metrics=None,event_every=0):
+    """Relay `lines` lines from the stub keepalived through a LogRelay, returning the seconds it took."""
+    child = Popen([sys.executable,stub_keepalived,str(lines),str(event_every)],stdout=PIPE,stderr=STDOUT)
+    log_relay = entry.LogRelay(child.stdout.fileno(),log_format,metrics)
+    started = time.time()
+    with Quiet():
+        log_relay.relay()
+    child.wait()
+    return time.time() - started
+
+def relay_readline(lines):
+    """Relay `lines` lines from the stub keepalived one line at a time to an unbuffered stdout, as entry.py did before
+    LogRelay, returning the seconds it took."""
+    child = Popen([sys.executable,stub_keepalived,str(lines)],stdout=PIPE,stderr=STDOUT)
+    started = time.time()
+    with Quiet():
+        stdout = os.fdopen(os.dup(1),'w',0)
+        for line in iter(child.stdout.readline, ''):
+            stdout.write(line)
+        stdout.close()
+    child.wait()
+    return time.time() - started
+
+def main():
+    print 'Log relay throughput from a stub keepalived'
+    lines = 1000000
+    seconds = relay(lines)
+    report('%d lines, plain' % lines,seconds,'s')
+    report('lines a second, plain',lines / seconds,'lines/s')
+    report('MB a second, plain',lines * 85 / seconds / 1e6,'MB/s') # Each line from the stub is 85 bytes
+    report('%d lines, plain, line by line (before LogRelay)' % (lines // 10),relay_readline(lines // 10),'s')
+    report('%d lines, plain with metrics' % lines,relay(lines,metrics=entry.Metrics()),'s')
+    report('%d lines, plain with metrics, all events' % lines,relay(lines,metrics=entry.Metrics(),event_every=1),'s')
+    report('%d lines, json' % lines,relay(lines,'json'),'s')
+    report('%d lines, json, every 100th line an event' % lines,relay(lines,'json',event_every=100),'s')
+    report('%d lines, json, all events' % lines,relay(lines,'json',event_every=1),'s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# How long a --config file takes to validate and the template takes to render, as the number of VIPs grows.
+import os
+import shutil
+import tempfile
+from common import timed, report, write_config, configure, render
+
+def main():
+    print 'Template render time against VIP count'
+    directory = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(directory,'keepalived.json')
+        output_path = os.path.join(directory,'keepalived.conf')
+        cache_path = os.path.join(directory,'template-cache')
+        for instances, vips in ((1, 10), (10, 100), (10, 1000), (10, 10000)):
+            write_config(config_path,instances,vips // instances)
+            context = configure(['--config',config_path])
+            report('%d VIPs over %d instances, validate' % (vips, instances),
+                   timed(lambda: configure(['--config',config_path])) * 1000,'ms')
+            report('%d VIPs over %d instances, render' % (vips, instances),
+                   timed(lambda: render(context,output_path)) * 1000,'ms')
+            render(context,output_path,cache_path) # Fill the template cache
+            report('%d VIPs over %d instances, render cached' % (vips, instances),
+                   timed(lambda: render(context,output_path,cache_path)) * 1000,'ms')
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
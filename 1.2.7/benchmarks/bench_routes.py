@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# How long tens of thousands of virtual routes take to parse and to check for conflicts with routes_check(), against
+# comparing every pair of routes as a check without the sorted index would.
+from common import entry, timed, report
+
+interfaces = set(['eth0'])
+vip_subnets = 1000
+
+def prefixes(version,count):
+    """Return `count` prefixes of IP `version`, a /24 or /64 each with a /16 or /48 enclosing every 256 of them so that
+    some routes overlap."""
+    if version == 4:
+        return ['100.%d.%d.0/24' % (i >> 8 & 255, i & 255) if i % 257 else '100.%d.0.0/16' % (i // 257 & 255)
+                for i in range(count)]
+    return ['2001:db8:%x:%x::/64' % (i >> 8, i & 255) if i % 257 else '2001:db8:%x::/48' % (i // 257)
+            for i in range(count)]
+
+def parse(version,route_strs):
+    """Parse `route_strs` into routes as route_check() does. IPv6 routes are rejected by route_check(), as keepalived
+    1.2.7 only supports IPv4 routes, so only their prefixes are parsed."""
+    routes = []
+    for route_str in route_strs:
+        if version == 4:
+            entry.route_check(routes,route_str + ' dev eth0',interfaces)
+        else:
+            routes.append({ 'addr' : route_str.partition('/')[0], 'mask' : route_str.partition('/')[2],
+                            'network' : entry.parse_prefix(route_str) })
+    return routes
+
+def instance(routes):
+    """Return an instance with `vip_subnets` VIPs and `routes`, as routes_check() expects them."""
+    return { 'virtual_ipaddresses'          : [{ 'addr' : '10.%d.%d.1' % (i >> 8, i & 255), 'mask' : '24' }
+                                               for i in range(vip_subnets)],
+             'virtual_ipaddresses_excluded' : [],
+             'virtual_routes'               : routes }
+
+def pairwise(routes):
+    """Find the pairs of `routes` that overlap by comparing every pair."""
+    overlaps = []
+    for index, route in enumerate(routes):
+        version, start, end = route['network']
+        for other in routes[index + 1:]:
+            if other['network'][0] == version and other['network'][1] <= end and start <= other['network'][2]:
+                overlaps.append((route, other))
+    return overlaps
+
+def main():
+    print 'Virtual route parsing and conflict checks, with %d VIP subnets' % vip_subnets
+    for count in (10000, 50000):
+        route_strs = dict((version, prefixes(version,count)) for version in (4, 6))
+        report('%d IPv4 + %d IPv6 prefixes, parse' % (count, count),
+               timed(lambda: [parse(version,route_strs[version]) for version in (4, 6)]),'s')
+        routes = parse(4,route_strs[4]) + parse(6,route_strs[6])
+        report('%d IPv4 + %d IPv6 prefixes, routes_check' % (count, count),
+               timed(lambda: entry.routes_check([instance(routes)])),'s')
+
+    count = 5000 # Comparing every pair of 100000 routes would take minutes
+    routes = parse(4,prefixes(4,count)) + parse(6,prefixes(6,count))
+    if len(pairwise(routes)) != len(entry.routes_check([instance(routes)])):
+        raise RuntimeError('routes_check() and the pairwise comparison found different overlaps')
+    report('%d IPv4 + %d IPv6 prefixes, routes_check' % (count, count),
+           timed(lambda: entry.routes_check([instance(routes)])),'s')
+    report('%d IPv4 + %d IPv6 prefixes, every pair' % (count, count),timed(lambda: pairwise(routes),1),'s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# How long each phase of startup takes, validating the configuration, the preflight check of an --enable-check URL and
+# rendering the template, run one after another as by default and overlapped as with --fast-start.
+import os
+import shutil
+import tempfile
+from common import entry, timed, report, write_config, render, Quiet, HTTPStandIn
+
+def main():
+    print 'Startup time by phase, default against --fast-start'
+    stand_in = HTTPStandIn(0.05) # A backend that takes 50ms to answer the preflight check
+    directory = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(directory,'keepalived.json')
+        output_path = os.path.join(directory,'keepalived.conf')
+        cache_path = os.path.join(directory,'template-cache')
+        write_config(config_path,10,100)
+        args = entry.parse_arguments(['--config',config_path,'--enable-check',stand_in.url])
+
+        def validate():
+            with Quiet():
+                return entry.configure(args)
+        context, checks = validate()[:2]
+        report('validation',timed(validate) * 1000,'ms')
+        report('preflight',timed(lambda: [check.run() for check in checks]) * 1000,'ms')
+        report('templates',timed(lambda: render(context,output_path)) * 1000,'ms')
+
+        def default_start():
+            context, checks = validate()[:2]
+            for check in checks:
+                check.run()
+            render(context,output_path)
+        def fast_start():
+            context, checks = validate()[:2]
+            for check in checks:
+                check.start()
+            render(context,output_path,cache_path)
+            for check in checks:
+                check.join()
+        render(context,output_path,cache_path) # Fill the template cache, as the first start with --fast-start does
+        report('all phases, default',timed(default_start) * 1000,'ms')
+        report('all phases, --fast-start',timed(fast_start) * 1000,'ms')
+    finally:
+        stand_in.stop()
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
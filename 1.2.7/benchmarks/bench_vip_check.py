@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# How many VIPs vip_check() validates a second, for IPv4 and IPv6 VIPs.
+from common import entry, timed, report
+import netifaces
+
+def main():
+    print 'vip_check throughput'
+    interfaces = set(netifaces.interfaces())
+    count = 10000
+    for version, vips in (('IPv4', ['10.%d.%d.%d/24/eth0' % (i >> 16, i >> 8 & 255, i & 255) for i in range(count)]),
+                          ('IPv6', ['2001:db8::%x/64/eth0' % i for i in range(count)])):
+        def run():
+            checked = []
+            for vip in vips:
+                entry.vip_check(checked,vip,False,interfaces)
+        seconds = timed(run)
+        report('%d %s VIPs' % (count, version),seconds,'s')
+        report('%s VIPs a second' % version,count / seconds,'VIPs/s')
+
+if __name__ == '__main__':
+    main()
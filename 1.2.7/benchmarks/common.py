@@ -0,0 +1,102 @@
+# Shared setup for the benchmarks. The stand-ins in stubs/ are put ahead of the real modules, so the benchmarks run
+# without privileges, without a network and without keepalived.
+import json
+import os
+import sys
+import time
+import BaseHTTPServer
+import SocketServer
+from threading import Thread
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+stubs_path = os.path.join(benchmarks_path,'stubs')
+scripts_path = os.path.join(benchmarks_path,'..','scripts')
+templates_path = os.path.join(benchmarks_path,'..','templates')
+sys.path[:0] = [stubs_path, scripts_path]
+
+import entry
+
+def timed(function,repeat=3):
+    """Return the fastest of `repeat` runs of `function` in seconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(name,value,unit):
+    print '    %-52s %12.3f %s' % (name, value, unit)
+    sys.stdout.flush()
+
+class Quiet(object):
+    """Sends anything written to stdout to /dev/null, including what is written straight to its file descriptor."""
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        devnull = os.open(os.devnull,os.O_WRONLY)
+        os.dup2(devnull,1)
+        os.close(devnull)
+    def __exit__(self,*exc_info):
+        sys.stdout.flush()
+        os.dup2(self.saved,1)
+        os.close(self.saved)
+
+def write_config(path,instances,vips):
+    """Write a --config file with `instances` instances of `vips` VIPs each, spread over the stub interfaces."""
+    config = { 'instances' : [], 'sync_groups' : [] }
+    for instance in range(instances):
+        interface = ('eth0','eth1')[instance % 2]
+        config['instances'].append({
+            'name'      : 'vip_%d' % instance,
+            'interface' : interface,
+            'vrid'      : instance // 2 + 1,
+            'priority'  : 100,
+            'auth_pass' : 'secret',
+            'include'   : ['10.%d.%d.%d/32/%s' % (address >> 16 & 255, address >> 8 & 255, address & 255, interface)
+                           for address in range(instance * vips + 1, (instance + 1) * vips + 1)],
+        })
+    with open(path,'w') as f:
+        json.dump(config,f)
+
+def configure(argv):
+    """Run entry's configure() for the command line `argv`, returning the template context."""
+    with Quiet():
+        return entry.configure(entry.parse_arguments(argv))[0]
+
+def render(context,path,cache_path=None):
+    """Render the keepalived template for `context` to `path` with entry's render_templates(), caching the compiled
+    template in `cache_path` as --fast-start does if it is given."""
+    entry.render_templates(context,templates_path,fast_start=cache_path is not None,output_path=path,
+                           cache_path=cache_path)
+
+class HTTPStandIn(object):
+    """A local HTTP server standing in for HAProxy, answering every request with 200 OK after `delay` seconds (or
+    five seconds for /slow). `requests` counts the requests it has answered."""
+    def __init__(self,delay=0):
+        stand_in = self
+        self.requests = 0
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Allow keep-alive
+            wbufsize = 65536 # Send each response in one write, it is flushed after each request
+            def do_GET(self):
+                stand_in.requests += 1
+                time.sleep(5 if self.path == '/slow' else delay)
+                self.send_response(200)
+                self.send_header('Content-Length','2')
+                self.end_headers()
+                self.wfile.write('OK')
+            def log_message(self,*args):
+                pass
+        class Server(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(('127.0.0.1',0),Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# The steady-state memory of a running container, in the default mode against --exec. Unlike the other benchmarks this
+# runs entry.py for real, so it has to be run where entry can write /etc/keepalived and start /usr/sbin/keepalived, such
+# as inside the container.
+#
+# usage: rss.py [SECONDS] [ENTRY ARGUMENTS...]
+#
+# Each mode is started with the ENTRY ARGUMENTS (default `lo 100 10.9.9.9/24/lo`) and left to settle for SECONDS
+# (default 5). The VmRSS of the container's main process, whatever it is by then, and the total of it and all of its
+# descendants are then read from /proc, the same way for every mode, before it is stopped with SIGTERM.
+import os
+import signal
+import subprocess
+import sys
+import time
+from common import scripts_path, report
+
+modes = [('default', []),
+         ('--supervise --metrics-port', ['--supervise','--metrics-port','9100']),
+         ('--exec', ['--exec'])]
+
+def children():
+    """Return a dictionary of the PIDs of the children of each process."""
+    tree = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                stat = f.read()
+        except IOError:
+            continue # The process has already exited
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1]) # The command name in brackets may itself contain spaces
+        tree.setdefault(ppid,[]).append(int(pid))
+    return tree
+
+def status(pid):
+    """Return the command name and VmRSS in kB of `pid`, from /proc/`pid`/status."""
+    name, rss = '?', 0
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('Name:'):
+                name = line.split()[1]
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+    return name, rss
+
+def measure(argv,seconds):
+    """Start entry with `argv`, returning the command name and VmRSS in kB of the main process and the total VmRSS in kB
+    of it and its descendants after `seconds`."""
+    with open(os.devnull,'w') as devnull:
+        main_process = subprocess.Popen([sys.executable,os.path.join(scripts_path,'entry.py')] + argv,stdout=devnull,
+                                        stderr=subprocess.STDOUT)
+    descendants = []
+    try:
+        time.sleep(seconds)
+        if main_process.poll() is not None:
+            raise RuntimeError('entry %s exited with %s before it was measured' % (' '.join(argv),
+                                                                                  main_process.returncode))
+        tree = children()
+        name, rss = status(main_process.pid)
+        total = rss
+        pending = list(tree.get(main_process.pid,[]))
+        while pending:
+            pid = pending.pop()
+            descendants.append(pid)
+            try:
+                total += status(pid)[1]
+            except IOError:
+                pass # The process has already exited
+            pending.extend(tree.get(pid,[]))
+        return name, rss, total
+    finally:
+        if main_process.poll() is None:
+            main_process.send_signal(signal.SIGTERM)
+        main_process.wait()
+        for pid in descendants: # With --exec the check daemon outlives keepalived, the container would take it down
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass # The process has already exited
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    seconds = float(argv[0]) if argv else 5
+    entry_argv = argv[1:] or ['lo','100','10.9.9.9/24/lo']
+    print 'Steady-state RSS after %gs, of the main process and of it and its descendants' % seconds
+    for mode, mode_argv in modes:
+        name, rss, total = measure(mode_argv + entry_argv,seconds)
+        report('%s, main process (%s)' % (mode, name),rss / 1024.0,'MB')
+        report('%s, all processes' % mode,total / 1024.0,'MB')
+
+if __name__ == '__main__':
+    main()
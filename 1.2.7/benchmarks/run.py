@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# Run every benchmark, or only those named on the command line (e.g. run.py relay render).
+import sys
+import bench_vip_check, bench_render, bench_config, bench_routes, bench_check, bench_relay, bench_startup
+
+benchmarks = [('vip_check', bench_vip_check), ('render', bench_render), ('config', bench_config),
+              ('routes', bench_routes), ('check', bench_check), ('relay', bench_relay), ('startup', bench_startup)]
+
+if __name__ == '__main__':
+    for name, benchmark in benchmarks:
+        if len(sys.argv) == 1 or name in sys.argv[1:]:
+            benchmark.main()
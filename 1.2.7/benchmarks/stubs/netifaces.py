@@ -0,0 +1,19 @@
+# A stand-in for netifaces for the benchmarks and tests, so that they do not depend on the interfaces of the host. The
+# interfaces are lo, eth0 and eth1, each with one IPv4 address.
+AF_LINK = 17
+AF_INET = 2
+AF_INET6 = 10
+
+addresses = {
+    'lo'   : '127.0.0.1',
+    'eth0' : '192.0.2.10',
+    'eth1' : '198.51.100.10',
+}
+
+def interfaces():
+    return sorted(addresses)
+
+def ifaddresses(interface):
+    if interface not in addresses:
+        raise ValueError('You must specify a valid interface name.')
+    return { AF_INET : [{ 'addr' : addresses[interface], 'netmask' : '255.255.255.0' }] }
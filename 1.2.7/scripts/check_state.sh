@@ -0,0 +1,18 @@
+#!/bin/sh
+# Read the result published by `check_haproxy --daemon` without starting a Python interpreter. This is the script
+# keepalived runs every interval when the check daemon is enabled.
+#
+# usage: check_state STATE_FILE MAX_AGE [MIN_CAPACITY]
+#
+# Passes only if the last check succeeded and the state file was refreshed within MAX_AGE seconds, so a check daemon
+# that has died or hung will demote this instance. If MIN_CAPACITY is given it instead passes only if at least that
+# percentage of servers were up, which is used to weight the priority of this instance by its healthy capacity.
+[ -r "$1" ] || exit 1
+read returncode timestamp latency capacity < "$1" || exit 1
+[ $(( $(date +%s) - timestamp )) -le "$2" ] || exit 1
+if [ -n "$3" ]; then
+    [ "${capacity:-0}" -ge "$3" ] || exit 1
+else
+    [ "$returncode" = "0" ] || exit 1
+fi
+exit 0
@@ -1,51 +1,81 @@
 #!/usr/bin/env python
 # This script processes the command line arguments and then start keepalived. It also checks if the container is running
-# in the correct network mode.
+# in the correct network mode. It can also be imported, in which case nothing is run until main() is called.
 
 ########################################################################################################################
 # LIBRARY IMPORT                                                                                                       #
 ########################################################################################################################
 # Import required libaries
 import sys,os,pwd,grp   # OS Libraries
+import time
+startup_started = time.time() # Used to report how long each phase of startup takes
+import filecmp          # Compare a newly rendered configuration with the current one
 import argparse         # Parse Arguments
 from subprocess import Popen, PIPE, STDOUT
                         # Open up a process
 import atexit
-from signal import signal, SIGTERM, SIGINT
-
-# Important required templating libarires
-from jinja2 import Environment as TemplateEnvironment, \
-                   FileSystemLoader, Template
-                        # Import the jinja2 libaries required by this script
-from jinja2.exceptions import TemplateNotFound
-                        # Import any exceptions that are caught by the Templates section
-                        
+from signal import signal, SIGTERM, SIGINT, SIGHUP
+
+# The templating (jinja2), IP (IPy), interface (netifaces) and request (requests) libraries are slow to import so are
+# only imported once they are needed, see vip_check(), configure(), render_templates() and preflight_urls()
+
 # Specific to the script
-from IPy import IP      # Library to verify if a given IP address is valid
-import netifaces
 from socket import gethostname as hostname
-from threading import Thread
+from threading import Thread, Lock, Condition
+import BaseHTTPServer   # Serves the metrics
 import stat
+import re
+import socket           # Allows you to talk to the HAProxy stats socket
+import pipes            # Allows you to quote arguments for the shell keepalived runs scripts with
+import json             # Allows you to read a JSON configuration file
 import urlparse         # Allows you to check the validity of a URL
-import requests         # Allows you to perform requests (like curl)
-
-from requests.exceptions import ConnectionError, SSLError
-                        # Handle request ConenctionError exceptions gracefully.
+import errno
+import struct,binascii  # Allows you to turn route prefixes into integers quickly
+import random           # Adds jitter to the delay before restarting keepalived
+import math
+import select           # Allows you to wait for VRRP advertisements on several interfaces at once
+import array            # Allows you to checksum VRRP advertisements quickly
                         
 # Varaibles/Consts
 scripts_path = '/ka-data/scripts/'
+log_events = [ # Messages from keepalived that are reported as events by --log-format json
+    ('state',      re.compile(r'VRRP_Instance\((?P<instance>[^)]+)\) Entering (?P<state>[A-Z]+) STATE')),
+    ('transition', re.compile(r'VRRP_Instance\((?P<instance>[^)]+)\) Transition to (?P<state>[A-Z]+) STATE')),
+    ('sync_group', re.compile(r'VRRP_Group\((?P<group>[^)]+)\) Syncing instances to (?P<state>[A-Z]+) state')),
+    ('script',     re.compile(r'VRRP_Script\((?P<script>[^)]+)\) (?P<result>succeeded|failed|timed out)')),
+]
+check_state_file = '/var/run/keepalived-check.state'
+notify_fifo = '/var/run/keepalived-notify.fifo'
+notify_states = ['MASTER','BACKUP','FAULT'] # The states keepalived runs notify scripts for
+template_cache_path = '/ka-data/.template-cache/'
+keepalived_conf_path = '/etc/keepalived/keepalived.conf'
+probe_cache_path = '/ka-data/.probe-cache/'
+dampening_state_path = '/ka-data/.vrrp-state.json'
+reload_lock = Lock() # Held by a reload while it renders the configuration and moves it into place
+flap_penalty = 1000 # The penalty added for each VRRP state change with --flap-dampening, as in BGP route flap dampening
+vrrp_protocol = 112
+vrrp_group = '224.0.0.18'
+vrrp_advert = struct.Struct('!BBBBBBH') # The version and type, VRID, priority, address count, auth type, advert
+                                        # interval and checksum that start each VRRPv2 advertisement
+failover_profiles = { # The timings set by --failover-profile, a check timeout of None is the check interval
+    'standard' : { 'advert_int' : 1, 'check_interval' : 2, 'check_rise' : 2, 'check_fall' : 2, 'check_timeout' : None },
+    'fast'     : { 'advert_int' : 1, 'check_interval' : 1, 'check_rise' : 2, 'check_fall' : 1, 'check_timeout' : 0.5 },
+}
 
 # Define the cleanup function
-def cleanup(child):
+def cleanup(child,log_relay=None):
     # Warning: This function can be registered more than once, code defensively!
     if child is not None: # Make sure the child actually exists
         print "Sending SIGTERM"
         child.terminate() # Terminate the child cleanly
+        if log_relay is None:
+            return # The child's output is not being relayed, nothing left to clear
         try:
-            for line in iter(child.stdout.readline, ''): # Clear the buffer of any lines remaining
-                sys.stdout.write(line)
-        except IOError:
+            log_relay.relay() # Clear the buffer of any lines remaining
+        except (IOError, OSError):
             pass # No output found, resulted in IOError
+        if log_relay.dampening is not None:
+            log_relay.dampening.stopped()
 
 
 # User defined exception
@@ -55,32 +85,938 @@ class SubprocessTimeoutError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class ConfigError(Exception):
+    """Raised when the instances being configured are not valid. The value is the message for the user."""
+    def __init__(self,value):
+        self.value = value
+    def __str__(self):
+        return str(self.value)
+
+class LogRelay(object):
+    """Copies the output of keepalived from the file descriptor `source` to stdout. Output is read and written in
+    chunks of whatever is available rather than line by line, so a busy keepalived costs a few large writes instead of
+    one write per line.
+
+    If `log_format` is json each line is instead written as a JSON object with a timestamp, and the messages in
+    `log_events` are parsed into typed events. If `metrics` is given the events are also recorded there, and if
+    `dampening` is given the state changes are recorded there."""
+    def __init__(self,source,log_format,metrics=None,dampening=None):
+        self.source = source
+        self.log_format = log_format
+        self.metrics = metrics
+        self.dampening = dampening
+        self.partial = '' # Any line that has only been partly read so far
+
+    def relay(self):
+        """Relay output until keepalived closes it."""
+        while self.relay_chunk():
+            pass
+
+    def relay_chunk(self):
+        """Relay whatever output is available, waiting for some if there is none. Returns False once keepalived has
+        closed its output."""
+        try:
+            chunk = os.read(self.source,65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return True # Interrupted by a signal, try again
+            raise
+        if not chunk:
+            if self.partial:
+                self.record_events(self.partial)
+                if self.log_format == 'json':
+                    self.write(self.format_lines([self.partial]))
+                self.partial = ''
+            return False
+
+        if self.log_format != 'json' and self.metrics is None and self.dampening is None:
+            self.write(chunk) # Nothing needs to look at the lines
+            return True
+
+        # Split off the incomplete last line until the rest of it is read. In plain mode it is still written now, and
+        # only held on to so that events are not missed when they are split between chunks
+        text = self.partial + chunk
+        end = text.rfind('\n') + 1
+        self.partial = text[end:]
+        self.record_events(text[:end])
+        if self.log_format == 'json':
+            chunk = self.format_lines(text[:end].split('\n')[:-1])
+        self.write(chunk)
+        return True
+
+    def record_events(self,text):
+        """Record any of the `log_events` in the complete lines `text` in the metrics and flap dampening."""
+        if (self.metrics is None and self.dampening is None) or 'VRRP_' not in text:
+            return # Every line in log_events contains VRRP_, so most chunks can skip parsing altogether
+        for line in text.split('\n'):
+            if 'VRRP_' in line:
+                event_type, fields = parse_event(line)
+                if self.metrics is not None:
+                    self.metrics.observe_event(event_type,fields)
+                if self.dampening is not None and event_type == 'state':
+                    self.dampening.observe(fields['instance'],fields['state'])
+
+    def format_lines(self,lines):
+        """Format complete `lines` for output."""
+        if self.log_format != 'json':
+            return ''.join(line + '\n' for line in lines)
+        now = time.time()
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)) + '.%03dZ' % (now % 1 * 1000)
+        prefix = '{"time": "%s", "event": ' % timestamp # Every line read in this chunk shares the same time
+
+        # The objects are built by hand as json.dumps() on a whole dictionary is several times slower. Lines are decoded
+        # first as json.dumps() raises on bytes that are not UTF-8, such as an interface name in another encoding
+        formatted = []
+        for line in lines:
+            line = line.decode('utf-8','replace')
+            event_type, fields = parse_event(line)
+            formatted.append(prefix + '"%s", "message": %s' % (event_type, json.dumps(line)))
+            for field in sorted(fields):
+                formatted.append(', "%s": %s' % (field, json.dumps(fields[field])))
+            formatted.append('}\n')
+        return ''.join(formatted)
+
+    def write(self,data):
+        """Write all of `data` to stdout."""
+        started = time.time()
+        size = len(data)
+        while data:
+            try:
+                data = data[os.write(sys.stdout.fileno(),data):]
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if self.metrics is not None:
+            self.metrics.observe_relay(size,time.time() - started)
+
+def parse_event(line):
+    """Parse a line of keepalived output into a tuple of the event type and its fields. Lines that are not one of the
+    `log_events` are log events with no fields."""
+    if 'VRRP_' in line: # Every line in log_events contains this, so most lines can skip the regular expressions
+        for event_type, pattern in log_events:
+            match = pattern.search(line)
+            if match is not None:
+                return event_type, match.groupdict()
+    return 'log', {}
+
+class Metrics(object):
+    """Collects the metrics served by --metrics-port, in the Prometheus text format. Each method only holds the lock
+    for as long as it takes to update or copy a few values, so a scrape can never hold up the log relay."""
+    vrrp_states = ['INIT','BACKUP','MASTER','FAULT']
+    latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.states = {}            # The current state of each instance and when it was entered
+        self.state_seconds = {}     # The seconds each instance has spent in each of its previous states
+        self.transitions = {}       # The number of times each instance has entered each state
+        self.script_results = {}    # The number of times keepalived has reported each result for each script
+        self.check_latency = self.histogram()
+        self.check_returncodes = {} # The number of checks by the check daemon that returned each return code
+        self.child_restarts = 0
+        self.child_recover = 0.0    # How long keepalived was down for before its last restart
+        self.notify_queue_depth = 0
+        self.notify_coalesced = 0   # The number of transitions that were superseded before their hooks were run
+        self.notify_latency = {}    # A histogram of how long each notify hook took
+        self.notify_results = {}    # The number of times each notify hook has returned each result
+        self.relay_bytes = 0
+        self.relay_writes = 0
+        self.relay_seconds = 0.0
+        self.relay_lag = 0.0        # How long the last write of keepalived's output took
+        self.dampening = None       # The FlapDampening to report the penalty and suppression of each instance from
+        self.monitor = None         # The VrrpMonitor to report the other routers from
+        self.probe_cache = None     # The directory of the probe cache to report the hits and misses of
+
+    def histogram(self):
+        """Return an empty histogram of `latency_buckets`, a list of the count in each bucket, the sum and the count."""
+        return [[0] * len(self.latency_buckets), 0.0, 0]
+
+    def observe_histogram(self,histogram,value):
+        for index, bucket in enumerate(self.latency_buckets):
+            if value <= bucket:
+                histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def add_instance(self,instance):
+        with self.lock:
+            self.states.setdefault(instance, ('INIT', time.time()))
+
+    def observe_event(self,event_type,fields):
+        """Record an event parsed from keepalived's output by parse_event()."""
+        now = time.time()
+        with self.lock:
+            if event_type == 'state':
+                previous, since = self.states.get(fields['instance'], ('INIT', now))
+                key = (fields['instance'], previous)
+                self.state_seconds[key] = self.state_seconds.get(key, 0) + now - since
+                self.states[fields['instance']] = (fields['state'], now)
+                key = (fields['instance'], fields['state'])
+                self.transitions[key] = self.transitions.get(key, 0) + 1
+            elif event_type == 'script':
+                key = (fields['script'], fields['result'])
+                self.script_results[key] = self.script_results.get(key, 0) + 1
+
+    def observe_check(self,returncode,latency):
+        """Record a check made by the check daemon."""
+        with self.lock:
+            self.observe_histogram(self.check_latency,latency)
+            self.check_returncodes[returncode] = self.check_returncodes.get(returncode, 0) + 1
+
+    def observe_relay(self,size,seconds):
+        """Record a write of `size` bytes of keepalived's output that took `seconds`."""
+        with self.lock:
+            self.relay_bytes += size
+            self.relay_writes += 1
+            self.relay_seconds += seconds
+            self.relay_lag = seconds
+
+    def observe_restart(self,seconds):
+        """Record a restart of keepalived after it had been down for `seconds`."""
+        with self.lock:
+            self.child_restarts += 1
+            self.child_recover = seconds
+
+    def set_notify_queue_depth(self,depth,coalesced=False):
+        """Record the number of transitions waiting for their notify hooks, and whether one was just superseded."""
+        with self.lock:
+            self.notify_queue_depth = depth
+            if coalesced:
+                self.notify_coalesced += 1
+
+    def observe_hook(self,hook,result,latency):
+        """Record a run of the notify `hook` that returned `result` after `latency` seconds."""
+        with self.lock:
+            self.observe_histogram(self.notify_latency.setdefault(hook, self.histogram()),latency)
+            self.notify_results[(hook, result)] = self.notify_results.get((hook, result), 0) + 1
+
+    def render(self):
+        """Return all of the metrics in the Prometheus text format."""
+        now = time.time()
+        with self.lock: # Take a copy of everything, and format it without holding the lock
+            states = dict(self.states)
+            state_seconds = dict(self.state_seconds)
+            transitions = dict(self.transitions)
+            script_results = dict(self.script_results)
+            check_latency = [list(self.check_latency[0])] + self.check_latency[1:]
+            check_returncodes = dict(self.check_returncodes)
+            child_restarts, child_recover = self.child_restarts, self.child_recover
+            notify = (self.notify_queue_depth, self.notify_coalesced)
+            notify_latency = dict((hook, [list(histogram[0])] + histogram[1:])
+                                  for hook, histogram in self.notify_latency.iteritems())
+            notify_results = dict(self.notify_results)
+            relay = (self.relay_bytes, self.relay_writes, self.relay_seconds, self.relay_lag)
+        dampening = self.dampening.status() if self.dampening is not None else {}
+        peers, invalid_adverts = self.monitor.status() if self.monitor is not None else ([], None)
+        probe_cache = {}
+        if self.probe_cache is not None:
+            try:
+                names = [name for name in os.listdir(self.probe_cache) if name.endswith('.stats')]
+            except OSError:
+                names = [] # Nothing has been probed yet
+            for name in names: # The counts are kept per probe, and a target may have been probed more than one way
+                try:
+                    with open(os.path.join(self.probe_cache,name)) as f:
+                        stats = json.load(f)
+                except (IOError, ValueError):
+                    continue # A check is part way through writing it
+                for target, target_stats in stats.iteritems():
+                    totals = probe_cache.setdefault(target, { 'hits' : 0, 'misses' : 0, 'expired' : 0, 'age' : 0.0 })
+                    for outcome in totals:
+                        totals[outcome] += target_stats.get(outcome,0)
+
+        for instance, (current, since) in states.iteritems():
+            key = (instance, current)
+            state_seconds[key] = state_seconds.get(key, 0) + now - since
+
+        lines = []
+        def sample(name,labels,value):
+            labels = ','.join('%s="%s"' % (label, str(labelvalue).replace('\\','\\\\').replace('"','\\"'))
+                              for label, labelvalue in labels)
+            lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '', repr(float(value))))
+        def metric(name,metric_type,helptext,samples):
+            lines.append('# HELP %s %s' % (name, helptext))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                sample(name,labels,value)
+        def histogram(name,helptext,samples):
+            lines.append('# HELP %s %s' % (name, helptext))
+            lines.append('# TYPE %s histogram' % name)
+            for labels, (buckets, total, count) in samples:
+                for bucket, bucket_count in zip(self.latency_buckets, buckets):
+                    sample(name + '_bucket',labels + (('le',repr(float(bucket))),),bucket_count)
+                sample(name + '_bucket',labels + (('le','+Inf'),),count)
+                sample(name + '_sum',labels,total)
+                sample(name + '_count',labels,count)
+
+        metric('keepalived_vrrp_state','gauge','Whether each VRRP instance is in each state',
+               [((('instance',instance),('state',state)), 1 if states[instance][0] == state else 0)
+                for instance in sorted(states) for state in self.vrrp_states])
+        metric('keepalived_vrrp_transitions_total','counter',
+               'The number of times each VRRP instance entered each state',
+               [((('instance',instance),('state',state)), count)
+                for (instance, state), count in sorted(transitions.iteritems())])
+        metric('keepalived_vrrp_state_seconds_total','counter','The seconds each VRRP instance has spent in each state',
+               [((('instance',instance),('state',state)), seconds)
+                for (instance, state), seconds in sorted(state_seconds.iteritems())])
+        metric('keepalived_vrrp_flap_penalty','gauge','The flap dampening penalty of each VRRP instance',
+               [((('instance',instance),), dampening[instance][0]) for instance in sorted(dampening)])
+        metric('keepalived_vrrp_flap_suppressed','gauge','Whether each VRRP instance is suppressed for flapping',
+               [((('instance',instance),), 1 if dampening[instance][1] else 0) for instance in sorted(dampening)])
+        metric('keepalived_vrrp_flap_transitions','gauge','The VRRP state changes of each instance kept in the flap'
+               ' history, including those from before keepalived was last started',
+               [((('instance',instance),), dampening[instance][2]) for instance in sorted(dampening)])
+        if self.monitor is not None:
+            labels = lambda peer: (('interface',peer[0]),('vrid',peer[1]),('router',peer[2]))
+            metric('keepalived_vrrp_peer_priority','gauge','The priority advertised by each other VRRP router',
+                   [(labels(peer), peer[3]) for peer in peers])
+            metric('keepalived_vrrp_peer_adverts_total','counter','The advertisements from each other VRRP router',
+                   [(labels(peer), peer[4]) for peer in peers])
+            metric('keepalived_vrrp_peer_advert_jitter_seconds','gauge','The smoothed difference between the time'
+                   ' between advertisements from each other VRRP router and its advert interval',
+                   [(labels(peer), peer[5]) for peer in peers])
+            metric('keepalived_vrrp_peer_active','gauge','Whether each other VRRP router is still advertising',
+                   [(labels(peer), 1 if peer[6] else 0) for peer in peers])
+            metric('keepalived_vrrp_peer_conflict','gauge','Whether each other VRRP router conflicts with an instance',
+                   [(labels(peer), 0 if peer[7] is None else 1) for peer in peers])
+            metric('keepalived_vrrp_invalid_adverts_total','counter','The VRRP packets that were not valid'
+                   ' advertisements', [((), invalid_adverts)])
+        if self.probe_cache is not None:
+            for outcome, helptext in (('hits','answered from the probe cache'),
+                                      ('misses','that probed a target not in the probe cache'),
+                                      ('expired','that probed a target whose result in the probe cache was too old')):
+                metric('keepalived_probe_cache_%s_total' % outcome,'counter','The checks by every container on this'
+                       ' host %s' % helptext,
+                       [((('target',target),), probe_cache[target][outcome]) for target in sorted(probe_cache)])
+            metric('keepalived_probe_cache_hit_age_seconds_total','counter','The total age of the results answered'
+                   ' from the probe cache, divide by the hits for the average staleness',
+                   [((('target',target),), probe_cache[target]['age']) for target in sorted(probe_cache)])
+        metric('keepalived_check_script_results_total','counter','The results keepalived has reported for each script',
+               [((('script',script),('result',result)), count)
+                for (script, result), count in sorted(script_results.iteritems())])
+        histogram('keepalived_check_latency_seconds','The latency of the checks made by the check daemon',
+                  [((), check_latency)])
+        metric('keepalived_check_returncodes_total','counter','The number of checks by the check daemon by return code',
+               [((('code',code),), count) for code, count in sorted(check_returncodes.iteritems())])
+        metric('keepalived_notify_queue_depth','gauge','The number of transitions waiting for their notify hooks',
+               [((), notify[0])])
+        metric('keepalived_notify_coalesced_total','counter',
+               'The number of transitions superseded by a later one before their notify hooks were run',
+               [((), notify[1])])
+        histogram('keepalived_notify_hook_seconds','How long each notify hook took',
+                  [((('hook',hook),), notify_latency[hook]) for hook in sorted(notify_latency)])
+        metric('keepalived_notify_hook_results_total','counter','The number of times each notify hook returned each'
+               ' result',[((('hook',hook),('result',result)), count)
+                          for (hook, result), count in sorted(notify_results.iteritems())])
+        metric('keepalived_child_restarts_total','counter','The number of times keepalived has been restarted',
+               [((), child_restarts)])
+        metric('keepalived_child_recover_seconds','gauge','How long keepalived was down for before its last restart',
+               [((), child_recover)])
+        metric('keepalived_log_relay_bytes_total','counter','The bytes of keepalived output relayed',[((), relay[0])])
+        metric('keepalived_log_relay_writes_total','counter','The number of writes of keepalived output',
+               [((), relay[1])])
+        metric('keepalived_log_relay_write_seconds_total','counter','The seconds spent writing keepalived output',
+               [((), relay[2])])
+        metric('keepalived_log_relay_lag_seconds','gauge','How long the last write of keepalived output took',
+               [((), relay[3])])
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the metrics of the server's `metrics` at /metrics."""
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass # Do not mix scrapes into keepalived's log
+
+def watch_check_state(metrics,path,interval):
+    """Record each result the check daemon publishes to `path` in `metrics`, looking for a new result twice every
+    `interval` seconds. This is intended to be run in its own thread."""
+    last_modified = None
+    while True:
+        try:
+            modified = os.stat(path).st_mtime
+            if modified != last_modified:
+                with open(path) as f:
+                    fields = f.read().split()
+                metrics.observe_check(int(fields[0]),int(fields[2]) / 1000.0)
+                last_modified = modified
+        except (IOError, OSError, ValueError, IndexError):
+            pass # The daemon has not published a result yet
+        time.sleep(interval / 2.0)
+
+class NotifyDispatcher(object):
+    """Runs the notify `hooks` for the VRRP transitions that keepalived writes to the FIFO at `fifo`.
+
+    keepalived only writes a line to the FIFO, so it never waits for a hook. The hooks are run with the arguments
+    keepalived gives a notify script (INSTANCE or GROUP, the name and the state) by a pool of `workers` threads, and
+    each is killed after `timeout` seconds. Only one transition per instance or group is run at a time, and while it
+    runs only the latest of any further transitions is kept, as a hook for a state that has already been left is
+    pointless. `hooks` maps a state to the hook for it, and None to the hook run for every state."""
+    def __init__(self,fifo,hooks,workers,timeout,metrics=None):
+        self.fifo = fifo
+        self.hooks = hooks
+        self.workers = workers
+        self.timeout = timeout
+        self.metrics = metrics
+        self.condition = Condition()
+        self.pending = {}     # The latest state waiting to be run for each instance or group
+        self.order = []       # The instances and groups in pending in the order they arrived
+        self.running = set()  # The instances and groups that have a hook running
+
+    def start(self):
+        """Start reading the FIFO and running hooks, each in their own thread."""
+        for target in [self.read] + [self.work] * self.workers:
+            thread = Thread(target=target)
+            thread.daemon = True # Do not wait for this thread when exiting
+            thread.start()
+
+    def read(self):
+        # Holding the write end open as well means keepalived never blocks opening the FIFO, and this never sees EOF
+        fd = os.open(self.fifo,os.O_RDWR)
+        partial = ''
+        while True:
+            try:
+                chunk = os.read(fd,65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                fields = line.split()
+                if len(fields) >= 3:
+                    self.submit(fields[0],fields[1],fields[2].upper())
+
+    def submit(self,event_type,name,state):
+        """Queue the hooks for `name` entering `state`, replacing any transition of it that has not been run yet."""
+        with self.condition:
+            key = (event_type, name)
+            coalesced = key in self.pending
+            if not coalesced:
+                self.order.append(key)
+            self.pending[key] = state
+            if self.metrics is not None:
+                self.metrics.set_notify_queue_depth(len(self.pending),coalesced)
+            self.condition.notify_all()
+
+    def next_transition(self):
+        """Wait for and return the oldest transition of an instance or group that has no hook running."""
+        with self.condition:
+            while True:
+                for key in self.order:
+                    if key not in self.running:
+                        self.order.remove(key)
+                        self.running.add(key)
+                        state = self.pending.pop(key)
+                        if self.metrics is not None:
+                            self.metrics.set_notify_queue_depth(len(self.pending))
+                        return key, state
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            (event_type, name), state = self.next_transition()
+            try:
+                for hook in (self.hooks.get(state), self.hooks.get(None)):
+                    if hook is not None:
+                        self.run_hook(hook,event_type,name,state)
+            finally:
+                with self.condition:
+                    self.running.discard((event_type, name))
+                    self.condition.notify_all() # A transition of this instance may be waiting for this one
+
+    def run_hook(self,hook,event_type,name,state):
+        started = time.time()
+        try:
+            result = 'succeeded' if run_command_with_timeout([hook,event_type,name,state],self.timeout) == 0 else \
+                     'failed'
+        except SubprocessTimeoutError:
+            print "The notify hook %s for %s entering %s was killed after %s seconds" % (hook, name, state,
+                                                                                         self.timeout)
+            result = 'timed out'
+        except OSError as e:
+            print "The notify hook %s could not be run (returned %s)" % (hook, e)
+            result = 'failed'
+        if self.metrics is not None:
+            self.metrics.observe_hook(os.path.basename(hook),result,time.time() - started)
+
+class FlapDampening(object):
+    """Keeps the state and recent state changes of each VRRP instance in `path`, so that they survive restarts, and
+    uses them to stop an instance that keeps changing state from taking over again.
+
+    As in BGP route flap dampening, each state change adds flap_penalty to the instance's penalty, which halves every
+    `half_life` seconds. An instance whose penalty reaches `suppress` is suppressed until it decays below `reuse`.
+    While it is suppressed the instance starts as a backup and does not preempt, and while its penalty is at or above
+    `reuse` it waits out a preempt delay before preempting.
+
+    When keepalived exits every instance is recorded as STOPPED, which is a flap for an instance that was the master
+    as it has lost its VIPs. Leaving STOPPED as keepalived starts again is not a flap."""
+    history_length = 100 # The state changes kept for each instance
+
+    def __init__(self,path,half_life,suppress,reuse):
+        self.path = path
+        self.half_life = half_life
+        self.suppress = suppress
+        self.reuse = reuse
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.changed = False    # Set when an instance is suppressed or released, until the configuration is rendered
+        self.restrained = set() # The instances the rendered configuration holds back from preempting
+        self.records = {}
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except IOError:
+            pass # Nothing has been recorded yet
+        except ValueError as e:
+            print "WARNING: The VRRP state file %s could not be read (returned %s), starting afresh" % (path, e)
+        if not isinstance(self.records, dict):
+            self.records = {}
+        for instance, record in self.records.items():
+            if not self.valid(record):
+                print "WARNING: The VRRP state file %s has an invalid record for %s, discarding it" % (path, instance)
+                del self.records[instance]
+        self.stopped() # keepalived is not running yet, even if it was not stopped cleanly last time
+
+    def valid(self,record):
+        """Return whether `record`, as read from the state file, has every field with a value of the right type."""
+        def number(value):
+            return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+        if not isinstance(record, dict):
+            return False
+        if not (record.get('state') is None or isinstance(record.get('state'), basestring)):
+            return False
+        if not number(record.get('penalty')) or record['penalty'] < 0 or not number(record.get('updated')):
+            return False
+        if not isinstance(record.get('suppressed'), bool) or not isinstance(record.get('transitions'), list):
+            return False
+        return all(isinstance(transition, list) and len(transition) == 2 and number(transition[0]) and
+                   isinstance(transition[1], basestring) for transition in record['transitions'])
+
+    def penalty(self,record,now):
+        return record['penalty'] * 0.5 ** ((now - record['updated']) / self.half_life)
+
+    def decayed(self,record):
+        """Return when the penalty of `record` will have decayed below the reuse threshold."""
+        if record['penalty'] <= self.reuse:
+            return record['updated']
+        # A second later, so that it has decayed below reuse rather than onto it
+        return record['updated'] + self.half_life * math.log(record['penalty'] / self.reuse, 2) + 1
+
+    def update_suppressed(self,instance,record,now):
+        """Suppress `instance` if its penalty has reached the suppress threshold, or release it once it has decayed
+        below the reuse threshold, returning its penalty."""
+        penalty = self.penalty(record,now)
+        if not record['suppressed'] and penalty >= self.suppress:
+            record['suppressed'] = True
+            errormsg = "WARNING: The VRRP instance %s has changed state %d times recently" % (instance,
+                                                                                           len(record['transitions']))
+            errormsg += " (penalty %d), it will not preempt until it is stable" % penalty
+            print errormsg
+        elif record['suppressed'] and penalty < self.reuse:
+            record['suppressed'] = False
+            print "The VRRP instance %s is stable again (penalty %d), it will preempt again" % (instance, penalty)
+        return penalty
+
+    def change(self,instance,state,now):
+        """Record `instance` entering a different `state` at `now`. Must be called with the lock held."""
+        record = self.records.setdefault(instance, { 'state' : None, 'penalty' : 0.0, 'updated' : now,
+                                                     'suppressed' : False, 'transitions' : [] })
+        # Only a change from a known state is a flap, and stopping is only a flap for the master
+        if record['state'] not in (None, 'STOPPED') and (state != 'STOPPED' or record['state'] == 'MASTER'):
+            record['penalty'] = self.penalty(record,now) + flap_penalty
+            record['updated'] = now
+        record['state'] = state
+        record['transitions'] = (record['transitions'] + [[now, state]])[-self.history_length:]
+        suppressed = record['suppressed']
+        self.update_suppressed(instance,record,now)
+        if record['suppressed'] != suppressed:
+            self.changed = True
+            self.condition.notify()
+
+    def observe(self,instance,state):
+        """Record `instance` entering `state`, which adds to its penalty if it was last in a different state."""
+        now = time.time()
+        with self.lock:
+            if instance in self.records and self.records[instance]['state'] == state:
+                return
+            self.change(instance,state,now)
+            self.save()
+
+    def stopped(self):
+        """Record keepalived exiting, which stops every instance."""
+        now = time.time()
+        with self.lock:
+            running = [instance for instance, record in self.records.iteritems() if record['state'] != 'STOPPED']
+            for instance in running:
+                self.change(instance,'STOPPED',now)
+            if running:
+                self.save()
+
+    def wait_for_change(self):
+        """Wait until the rendered configuration no longer matches the dampening, either because a state change has
+        suppressed or released an instance or because an instance it holds back has decayed below reuse."""
+        with self.lock:
+            while not self.changed:
+                now = time.time()
+                decayed = dict((instance, self.decayed(self.records[instance])) for instance in self.restrained
+                               if instance in self.records)
+                due = [instance for instance in decayed if decayed[instance] <= now]
+                if due:
+                    self.restrained.difference_update(due) # So that a render that fails is not retried at once
+                    break
+                self.condition.wait(min(decayed.values()) - now if decayed else None)
+            self.changed = False
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path,'w') as f:
+                json.dump(self.records,f)
+            os.rename(temp_path,self.path) # rename() is atomic, a reader will never see a partial file
+        except (IOError, OSError) as e:
+            print "WARNING: The VRRP state file %s could not be written (returned %s)" % (self.path, e)
+
+    def apply(self,instances):
+        """Set nopreempt or preempt_delay on any of `instances` that have been changing state, for the configuration
+        about to be rendered."""
+        now = time.time()
+        with self.lock:
+            self.changed = False
+            self.restrained = set()
+            for instance in instances:
+                record = self.records.get(instance['name'])
+                if record is None:
+                    continue
+                penalty = self.update_suppressed(instance['name'],record,now)
+                # keepalived only allows nopreempt and preempt_delay on an instance that starts as BACKUP
+                if record['suppressed']:
+                    instance['is_master'] = False
+                    instance['nopreempt'] = True
+                    self.restrained.add(instance['name'])
+                elif penalty >= self.reuse:
+                    # Wait until the penalty would have decayed below reuse, at most the 1000 seconds keepalived allows
+                    delay = self.half_life * math.log(penalty / self.reuse, 2)
+                    instance['is_master'] = False
+                    instance['preempt_delay'] = min(1000, int(math.ceil(delay)))
+                    self.restrained.add(instance['name'])
+            self.save()
+
+    def status(self):
+        """Return the penalty, whether it is suppressed and the number of state changes kept of each instance."""
+        now = time.time()
+        with self.lock:
+            return dict((instance, (self.penalty(record,now), record['suppressed'], len(record['transitions'])))
+                        for instance, record in self.records.iteritems())
+
+def decode_advert(packet):
+    """Decode the IPv4 packet `packet` as a VRRPv2 advertisement, returning a tuple of the source address, VRID,
+    priority, advert interval, auth type, auth data and the tuple of addresses it advertises. Returns None if it is
+    not a valid advertisement, including one that keepalived would drop for its TTL or checksum."""
+    if len(packet) < 28 or ord(packet[8]) != 255: # Advertisements are only valid if sent with a TTL of 255
+        return None
+    start = (ord(packet[0]) & 0x0f) * 4 # The IP header length
+    try:
+        version_type, vrid, priority, count, auth_type, advert_int, checksum = vrrp_advert.unpack_from(packet,start)
+    except struct.error:
+        return None
+    end = start + 16 + 4 * count # The header, the addresses and 8 bytes of auth data
+    if version_type != 0x21 or len(packet) < end:
+        return None # Not a version 2 advertisement, or truncated
+
+    # The one's complement sum of the advertisement, including its checksum, is 0xffff in either byte order
+    total = sum(array.array('H', packet[start:end]))
+    total = (total & 0xffff) + (total >> 16)
+    if (total & 0xffff) + (total >> 16) != 0xffff:
+        return None
+
+    addresses = tuple([socket.inet_ntoa(packet[offset:offset + 4]) for offset in xrange(start + 8, end - 8, 4)])
+    return socket.inet_ntoa(packet[12:16]), vrid, priority, advert_int, auth_type, packet[end - 8:end], addresses
+
+def read_pcap(f):
+    """Read the pcap capture from the file `f`, yielding a tuple of the timestamp and the IPv4 packet of each IPv4
+    packet in it. Ethernet (including VLAN tagged), Linux cooked and raw IP captures are understood."""
+    header = f.read(24)
+    if len(header) < 24:
+        return
+    for order, precision in (('<', 1e-6), ('>', 1e-6), ('<', 1e-9), ('>', 1e-9)):
+        magic, = struct.unpack(order + 'I', header[:4])
+        if magic == (0xa1b2c3d4 if precision == 1e-6 else 0xa1b23c4d):
+            break
+    else:
+        raise ValueError("The file is not a pcap capture")
+    linktype = struct.unpack(order + 'I', header[20:24])[0] & 0x0fffffff
+    record = struct.Struct(order + 'IIII')
+
+    while True:
+        header = f.read(16)
+        if len(header) < 16:
+            return
+        seconds, fraction, length, _ = record.unpack(header)
+        frame = f.read(length)
+        if linktype == 1: # Ethernet, skipping any VLAN tags
+            offset = 12
+            while frame[offset:offset + 2] in ('\x81\x00', '\x88\xa8'):
+                offset += 4
+            if frame[offset:offset + 2] != '\x08\x00':
+                continue
+            packet = frame[offset + 2:]
+        elif linktype == 113: # Linux cooked
+            if frame[14:16] != '\x08\x00':
+                continue
+            packet = frame[16:]
+        elif linktype in (101, 228): # Raw IP, or raw IPv4
+            packet = frame
+        else:
+            raise ValueError("The pcap link type %d is not supported" % linktype)
+        yield seconds + fraction * precision, packet
+
+class VrrpMonitor(object):
+    """Listens for the VRRP advertisements on the interfaces of `instances` to find the other routers there.
+
+    A router on the VRID of one of the instances that advertises a different password, set of addresses or advert
+    interval conflicts with it, keepalived would drop its advertisements and both would become master. Adverts from
+    `local_addresses` are this host's own and are ignored.
+
+    For every router seen, its priority, the number of advertisements and their jitter are kept. The jitter is
+    smoothed as in RTP, from the difference between the time between advertisements and the advert interval."""
+    def __init__(self,instances,advert_int,local_addresses):
+        self.local_addresses = local_addresses
+        self.advert_int = advert_int
+        self.lock = Lock()
+        self.expect(instances)
+        self.interfaces = sorted(set(interface for interface, vrid in self.expected))
+        self.sockets = {}
+        self.peers = {}   # The [priority, advert interval, adverts, last seen, jitter, conflict] of each peer
+        self.invalid = 0  # Packets that were not valid advertisements
+
+    def expect(self,instances):
+        """Compare the advertisements with `instances` from now on. Only the interfaces of the instances the monitor
+        was created with are listened on."""
+        expected = {} # The auth data, addresses and advert interval of each instance by interface and VRID
+        for instance in instances:
+            addresses = tuple(sorted(vip['addr'] for vip in instance['virtual_ipaddresses'] if ':' not in vip['addr']))
+            auth = (instance['auth_pass'] or '')[:8].ljust(8, '\0') # keepalived only sends the first 8 characters
+            expected[(instance['track_iface'], instance['virtual_router_id'])] = (instance['name'], auth, addresses,
+                                                                                 self.advert_int)
+        self.expected = expected # Replaced whole so that observe() never sees it part way through being built
+
+    def open(self):
+        """Open a raw socket for VRRP on each interface, raising socket.error if that is not allowed."""
+        for interface in self.interfaces:
+            sock = socket.socket(socket.AF_INET,socket.SOCK_RAW,vrrp_protocol)
+            sock.setsockopt(socket.SOL_SOCKET,25,interface + '\0') # SO_BINDTODEVICE
+            try: # Join the VRRP group, until keepalived has done so the advertisements would be filtered out
+                with open('/sys/class/net/%s/ifindex' % interface) as f:
+                    index = int(f.read())
+                mreqn = struct.pack('4s4si',socket.inet_aton(vrrp_group),socket.inet_aton('0.0.0.0'),index)
+                sock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,mreqn)
+            except (IOError, ValueError, socket.error) as e:
+                print "WARNING: Could not join the VRRP group on %s (returned %s)" % (interface, e)
+            self.sockets[sock] = interface
+
+    def conflict(self,expected,advert):
+        """Return why the `advert` conflicts with the `expected` instance, or None if it does not."""
+        name, auth, addresses, advert_int = expected
+        if advert[4] != 1 or advert[5] != auth:
+            return "a different password"
+        if addresses and tuple(sorted(advert[6])) != addresses:
+            return "the addresses %s rather than %s" % (', '.join(advert[6]), ', '.join(addresses))
+        if advert[3] != advert_int:
+            return "an advert interval of %ds rather than %ds" % (advert[3], advert_int)
+        return None
+
+    def observe(self,interface,packet,now):
+        """Record the `packet` received on `interface` at `now`."""
+        advert = decode_advert(packet)
+        if advert is None:
+            with self.lock:
+                self.invalid += 1
+            return
+        source, vrid, priority, advert_int = advert[:4]
+        if source in self.local_addresses:
+            return
+        key = (interface, vrid, source)
+        with self.lock:
+            peer = self.peers.get(key)
+            seen = peer is not None
+            if seen:
+                peer[4] += (abs(now - peer[3] - advert_int) - peer[4]) / 16
+                peer[0], peer[1], peer[3] = priority, advert_int, now
+                peer[2] += 1
+            else:
+                self.peers[key] = peer = [priority, advert_int, 1, now, 0.0, None]
+        expected = self.expected.get((interface, vrid))
+        if expected is None:
+            if not seen:
+                print "Found a VRRP router %s on %s for VRID %d with priority %d" % (source, interface, vrid, priority)
+            return
+        conflict = self.conflict(expected,advert)
+        if seen and conflict == peer[5]:
+            return # Only report the peer when it is first seen or it starts or stops conflicting
+        peer[5] = conflict
+        if conflict is None:
+            errormsg = "Found the VRRP peer %s on %s for instance %s (VRID %d) with priority %d" % (
+                source, interface, expected[0], vrid, priority)
+        else:
+            errormsg = "WARNING: The VRRP router %s on %s conflicts with instance %s, it uses VRID %d with %s" % (
+                source, interface, expected[0], vrid, conflict)
+        print errormsg
+
+    def run(self,deadline=None):
+        """Receive and record advertisements until `deadline`, or forever if it is not given."""
+        while True:
+            timeout = None if deadline is None else deadline - time.time()
+            if timeout is not None and timeout <= 0:
+                return
+            try:
+                readable = select.select(list(self.sockets),[],[],timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sock in readable:
+                self.observe(self.sockets[sock],sock.recv(65535),time.time())
+
+    def listen(self,seconds):
+        """Listen for `seconds` before keepalived is started. Returns an error message if any router conflicts with
+        one of the instances, or None if none do."""
+        self.run(time.time() + seconds)
+        with self.lock:
+            conflicts = sum(1 for peer in self.peers.itervalues() if peer[5] is not None)
+        if conflicts:
+            return "%d VRRP routers conflict with the instances, see the warnings above" % conflicts
+        return None
+
+    def status(self):
+        """Return the interface, VRID, source, priority, advert count, jitter, whether it is still active and any
+        conflict of each router seen, and the number of invalid packets."""
+        now = time.time()
+        with self.lock:
+            peers = [(interface, vrid, source, peer[0], peer[2], peer[4], now - peer[3] <= 3 * peer[1] + 1, peer[5])
+                     for (interface, vrid, source), peer in sorted(self.peers.iteritems())]
+            return peers, self.invalid
+
+class Supervisor(object):
+    """Runs keepalived with `command`, relaying its output through `log_relay`, and waits for it to exit.
+
+    If `restart_limit` is given keepalived is restarted in place when it exits, with the configuration that was
+    already rendered, instead of the container being restarted and repeating all of startup. Each restart is delayed
+    by `backoff` seconds, doubling for every exit within the last `restart_window` seconds up to `max_backoff`, with
+    jitter so that containers that failed together do not restart in step. Once keepalived has exited more than
+    `restart_limit` times within `restart_window` seconds it is left to the container to restart. If `before_restart`
+    is given it is called before each restart, to render the configuration afresh. The same is used for the check
+    daemon, with `name` used in the messages."""
+    def __init__(self,command,log_relay,metrics=None,restart_limit=None,restart_window=60,backoff=1,max_backoff=30,
+                 name='keepalived',before_restart=None):
+        self.command = command
+        self.name = name
+        self.log_relay = log_relay
+        self.metrics = metrics
+        self.restart_limit = restart_limit
+        self.restart_window = restart_window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.before_restart = before_restart
+        self.child = None
+        self.stopping = False # Set once keepalived is being stopped on purpose, it is not restarted after that
+
+    def spawn(self):
+        self.child = Popen(self.command, stdout = PIPE, stderr = STDOUT, shell = False)
+        self.log_relay.source = self.child.stdout.fileno()
+
+    def send_signal(self,signum):
+        """Send `signum` to keepalived, returning False if it has exited and is waiting to be restarted instead. Its
+        PID may already belong to another process, and the restart will read the configuration afresh anyway."""
+        if self.child is None or self.child.poll() is not None:
+            return False
+        self.child.send_signal(signum)
+        return True
+
+    def terminate(self):
+        self.stopping = True
+        if self.child is not None and self.child.poll() is None:
+            self.child.terminate()
+
+    def run(self):
+        """Relay keepalived's output until it exits and is not restarted, returning its return code. keepalived must
+        already have been started with spawn()."""
+        exits = [] # When keepalived exited within the restart window
+        while True:
+            self.log_relay.relay()
+            returncode = self.child.wait()
+            exited = time.time()
+            self.child.stdout.close()
+            if self.log_relay.dampening is not None:
+                self.log_relay.dampening.stopped()
+            if self.stopping or self.restart_limit is None:
+                return returncode
+
+            exits = [exit_time for exit_time in exits if exit_time > exited - self.restart_window] + [exited]
+            if len(exits) > self.restart_limit:
+                errormsg = "%s exited %d times in %s seconds (returned %s)," % (self.name, len(exits),
+                                                                                self.restart_window, returncode)
+                errormsg += " terminating..."
+                print errormsg
+                return returncode
+
+            delay = min(self.max_backoff, self.backoff * 2 ** (len(exits) - 1))
+            delay = random.uniform(delay / 2.0, delay)
+            print "%s exited (returned %s), restarting it in %.1f seconds" % (self.name, returncode, delay)
+            time.sleep(delay)
+            if self.stopping:
+                return returncode
+            if self.before_restart is not None:
+                self.before_restart()
+            self.spawn()
+            recover = time.time() - exited
+            print "%s was restarted %.1f seconds after it exited (%d exits in the last %s seconds)" % (
+                self.name, recover, len(exits), self.restart_window)
+            if self.metrics is not None:
+                self.metrics.observe_restart(recover)
+
+def watch_check_daemon(check_daemon):
+    """Run the `check_daemon` Supervisor, restarting the daemon whenever it exits. If it can not be kept running
+    entry is terminated, as keepalived would otherwise only see an ever older result and stay in FAULT. This is
+    intended to be run in its own thread."""
+    returncode = check_daemon.run()
+    if not check_daemon.stopping:
+        print "The check daemon could not be kept running (returned %s), terminating..." % returncode
+        os.kill(os.getpid(),SIGTERM) # Stop keepalived and exit as the SIGTERM handler does
+
 # Functions
-def vip_check(vips,check_str,exclude):
-    """Check the `check_str` to see if it is valid, and import it into `vips`."""
+def vip_check(vips,check_str,exclude,interfaces):
+    """Check the `check_str` to see if it is valid, and import it into `vips`. `interfaces` is the set of interfaces
+    on this host."""
+    from IPy import IP  # Library to verify if a given IP address is valid, slow to import so only imported when needed
     check = check_str.split('/')
     if len(check) != 3:
-        print "The argument %s provided does not have 3 '/' delimited arguments, terminating" % check_str
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+        raise ConfigError("The argument %s provided does not have 3 '/' delimited arguments" % check_str)
     try:
         check_ip = IP(check[0])
     except ValueError as e:
-        print "The IP %s does not appear to be a valid (returned %s), terminating..." % (check[0], e)
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+        raise ConfigError("The IP %s does not appear to be a valid (returned %s)" % (check[0], e))
     
     try:
         if check_ip.version() is 6 and (int(check[1]) > 128 or int(check[1]) < 0):
-            print "The subnet %s is not a valid subnet for an IPv6 address, terminating" % check[1]
-            sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+            raise ConfigError("The subnet %s is not a valid subnet for an IPv6 address" % check[1])
         elif check_ip.version() is 4 and (int(check[1]) > 32 or int(check[1]) < 0):
-            print "The subnet %s is not a valid subnet for an IPv4 address, terminating" % check[1]
-            sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+            raise ConfigError("The subnet %s is not a valid subnet for an IPv4 address" % check[1])
     except ValueError as e:
-        print "The subnet %s is not a valid intetge (returned %s), terminating" % (check[1], e)
+        raise ConfigError("The subnet %s is not a valid intetge (returned %s)" % (check[1], e))
         
-    if check[2] not in netifaces.interfaces():
-        print "The iface %s does not appear to be a valid interface on this host, terminating..." % check[2]
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+    if check[2] not in interfaces:
+        raise ConfigError("The iface %s does not appear to be a valid interface on this host" % check[2])
     
     vip_obj = { 'addr'    : check_ip.strNormal(0),      # Print string without a mask
                 'mask'    : check[1],                   # Prefix length
@@ -89,6 +1025,427 @@ def vip_check(vips,check_str,exclude):
               }
     vips.append(vip_obj)
     
+def parse_address(addr):
+    """Return a tuple of the IP version and the integer value of the address `addr`, or raise ValueError if it is not
+    valid. This is used for routes rather than IPy, which is too slow for tens of thousands of them."""
+    try:
+        return 4, struct.unpack('!I',socket.inet_pton(socket.AF_INET,addr))[0]
+    except socket.error:
+        pass
+    try:
+        return 6, int(binascii.hexlify(socket.inet_pton(socket.AF_INET6,addr)),16)
+    except socket.error:
+        raise ValueError("%s is not an IPv4 or IPv6 address" % addr)
+
+def parse_prefix(prefix):
+    """Return a tuple of the IP version and the first and last addresses, as integers, of the network `prefix` in the
+    form 203.0.113.0/24. A prefix without a length is a single address."""
+    addr, _, length = prefix.partition('/')
+    version, start = parse_address(addr)
+    bits = 32 if version == 4 else 128
+    length = int(length) if length else bits
+    if length < 0 or length > bits:
+        raise ValueError("%d is not a valid prefix length for an IPv%d address" % (length, version))
+    host = (1 << (bits - length)) - 1
+    if start & host:
+        raise ValueError("%s has host bits set" % prefix)
+    return version, start, start | host
+
+def route_check(routes,route_str,interfaces):
+    """Check the route `route_str`, written as it would be in keepalived's virtual_routes block, to see if it is
+    valid, and import it into `routes`. `interfaces` is the set of interfaces on this host."""
+    route = { 'src' : None, 'addr' : None, 'mask' : None, 'via' : None, 'via2' : None, 'iface' : None,
+              'blackhole' : False }
+    tokens = route_str.split()
+    if tokens[:1] == ['blackhole']:
+        route['blackhole'] = True
+        tokens = tokens[1:]
+        if len(tokens) != 1:
+            raise ConfigError("The blackhole route %s must only give a destination" % route_str)
+
+    options = { 'src' : 'src', 'via' : 'via', 'or' : 'via2', 'dev' : 'iface' }
+    destination = None
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in options:
+            if index + 1 == len(tokens) or route[options[token]] is not None:
+                raise ConfigError("The route %s must give %s once followed by a value" % (route_str, token))
+            route[options[token]] = tokens[index + 1]
+            index += 2
+            continue
+        if token == 'to' and index + 1 < len(tokens):
+            token = tokens[index + 1]
+            index += 1
+        if destination is not None:
+            raise ConfigError("The route %s has more than one destination" % route_str)
+        destination = token
+        index += 1
+    if destination is None:
+        raise ConfigError("The route %s does not have a destination" % route_str)
+
+    try:
+        route['network'] = parse_prefix(destination)
+        for key in ('src','via','via2'):
+            if route[key] is not None and parse_address(route[key])[0] != route['network'][0]:
+                raise ValueError("%s is not the same IP version as %s" % (route[key], destination))
+    except ValueError as e:
+        raise ConfigError("The route %s is not valid (returned %s)" % (route_str, e))
+    if route['network'][0] != 4:
+        raise ConfigError("The route %s is IPv6, this version of keepalived only supports IPv4 routes" % route_str)
+    if route['via2'] is not None and route['via'] is None:
+        raise ConfigError("The route %s gives a second gateway with 'or' but no first gateway with 'via'" % route_str)
+    if route['iface'] is not None and route['iface'] not in interfaces:
+        raise ConfigError("The iface %s does not appear to be a valid interface on this host" % route['iface'])
+
+    route['addr'], route['mask'] = destination.partition('/')[0], destination.partition('/')[2] or '32'
+    routes.append(route)
+
+def routes_check(instances):
+    """Check the routes of all of `instances` against each other and against their VIPs, returning a list of the
+    pairs of routes where one overlaps the other. A route given more than once, or a route that takes over part of
+    the subnet of a VIP, raises ConfigError.
+
+    CIDR networks are either nested or disjoint, so once every network is sorted by its first address (largest
+    first) a single pass with a stack of the networks that enclose the current one finds every conflict. This takes
+    O(n log n) rather than comparing every pair."""
+    networks = []
+    for instance in instances:
+        for vip in instance['virtual_ipaddresses'] + instance['virtual_ipaddresses_excluded']:
+            version, addr = parse_address(vip['addr'])
+            host = (1 << ((32 if version == 4 else 128) - int(vip['mask']))) - 1
+            networks.append((version, addr & ~host, addr | host, 'vip', vip))
+        for route in instance['virtual_routes'] or []:
+            networks.append(route['network'] + ('route', route))
+    networks.sort(key=lambda network: (network[0], network[1], -network[2], network[3] == 'route'))
+
+    overlaps = []
+    enclosing = [] # The networks enclosing the current one with the innermost VIP and route enclosing each
+    for version, start, end, kind, item in networks:
+        while enclosing and (enclosing[-1][0] != version or enclosing[-1][1] < start):
+            enclosing.pop()
+        vip, route = enclosing[-1][2:] if enclosing else (None, None)
+        if kind == 'route':
+            if route is not None and route['network'] == item['network']:
+                raise ConfigError("The route to %s/%s is given more than once" % (item['addr'], item['mask']))
+            if vip is not None:
+                errormsg = "The route to %s/%s would take over the subnet" % (item['addr'], item['mask'])
+                errormsg += " of the VIP %s/%s" % (vip['addr'], vip['mask'])
+                raise ConfigError(errormsg)
+            if route is not None:
+                overlaps.append((route, item))
+            route = item
+        else:
+            vip = item
+        enclosing.append((version, end, vip, route))
+    return overlaps
+
+def load_config(path):
+    """Load the declarative configuration file at `path`. It is read as YAML if it ends in .yaml or .yml, otherwise it
+    is read as JSON."""
+    try:
+        with open(path) as f:
+            if path.endswith('.yaml') or path.endswith('.yml'):
+                try:
+                    import yaml # Only required for YAML configuration files
+                except ImportError:
+                    raise ConfigError("The YAML library is not installed so %s can not be read" % path)
+                try:
+                    config = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    raise ValueError(e)
+            else:
+                config = json.load(f)
+    except IOError as e:
+        raise ConfigError("The configuration file %s could not be opened (returned %s)" % (path, e))
+    except ValueError as e:
+        raise ConfigError("The configuration file %s could not be parsed (returned %s)" % (path, e))
+
+    if not isinstance(config, dict) or not isinstance(config.get('instances'), list) or not config['instances']:
+        raise ConfigError("The configuration file %s does not contain a list of instances" % path)
+    return config
+
+def instance_check(instances,item,interfaces):
+    """Check the instance `item` from the configuration to see if it is valid, and import it into `instances`.
+    `interfaces` is the set of interfaces on this host."""
+    if not isinstance(item, dict):
+        raise ConfigError("The instance %s is not a mapping" % item)
+    name = str(item.get('name', 'vip_%s' % item.get('vrid')))
+    if not re.match(r'^[A-Za-z0-9_.-]+$', name):
+        raise ConfigError("The instance name %s may only contain letters, numbers, '_', '.' and '-'" % name)
+
+    for key, lower, upper in (('vrid',1,255), ('priority',1,255)):
+        if not isinstance(item.get(key), int) or isinstance(item[key], bool) or item[key] < lower or item[key] > upper:
+            raise ConfigError("The %s of instance %s must be between %d and %d" % (key, name, lower, upper))
+
+    if item.get('interface') not in interfaces:
+        raise ConfigError("The iface %s does not appear to be a valid interface on this host" % item.get('interface'))
+
+    for key in ('include','exclude','routes'):
+        if not isinstance(item.get(key, []), list):
+            raise ConfigError("The %s of instance %s must be a list" % (key, name))
+    if not item.get('include'):
+        raise ConfigError("The instance %s must include at least one VIP" % name)
+
+    vips = []
+    for vip in item['include']:
+        vip_check(vips,str(vip),False,interfaces)
+    for vip in item.get('exclude', []):
+        vip_check(vips,str(vip),True,interfaces)
+    routes = []
+    for route in item.get('routes', []):
+        route_check(routes,str(route),interfaces)
+
+    instances.append({ 'name'                         : name,
+                       'track_iface'                  : item['interface'],
+                       'is_master'                    : bool(item.get('master', False)),
+                       'auth_pass'                    : item.get('auth_pass'),
+                       'virtual_router_id'            : item['vrid'],
+                       'priority'                     : item['priority'],
+                       'track_check'                  : bool(item.get('track_check', True)),
+                       'nopreempt'                    : False, # Set by flap dampening
+                       'preempt_delay'                : None,
+                       'virtual_ipaddresses'          : [vip for vip in vips if vip['include']],
+                       'virtual_ipaddresses_excluded' : [vip for vip in vips if not vip['include']],
+                       'virtual_routes'               : routes or None, # Only IPv4 routes are supported by
+                                                                      # the version of keepalived this container
+                                                                      # has been built to use
+                     })
+
+def load_instances(args,interfaces):
+    """Check and import the VRRP instances and sync groups, either from the command line arguments `args` or from the
+    configuration file they give. `interfaces` is the set of interfaces on this host.
+
+    Returns a tuple of the instances and sync groups, or raises ConfigError if they are not valid."""
+    if args.config is None:
+        if args.track_iface is None or args.priority is None or not args.include:
+            raise ConfigError("The track_iface, priority and include arguments are required without --config")
+
+        vrid  = args.vrid
+        if vrid is None:
+            errormsg = 'WARNING: Not setting a vrid could result in a conflict. Please specify a vrid to avoid'
+            errormsg += ' possible conflicts'
+            print errormsg
+            vrid = 1
+
+        routes = args.route if args.route is not None else []
+        if args.route_file is not None:
+            try:
+                with open(args.route_file) as f:
+                    routes = routes + [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            except IOError as e:
+                raise ConfigError("The route file %s could not be read (returned %s)" % (args.route_file, e))
+
+        instances_config = [{ 'name'      : 'vip',
+                              'interface' : args.track_iface,
+                              'priority'  : args.priority,
+                              'vrid'      : vrid,
+                              'master'    : args.master,
+                              'include'   : args.include,
+                              'exclude'   : args.exclude if args.exclude is not None else [],
+                              'routes'    : routes,
+                            }]
+        sync_groups_config = []
+    else:
+        if args.track_iface is not None or args.vrid is not None or args.exclude is not None or \
+           args.route is not None or args.route_file is not None:
+            errormsg = "The track_iface, priority, include, --vrid, --exclude, --route and --route-file arguments can"
+            errormsg += " not be used with --config"
+            raise ConfigError(errormsg)
+        config = load_config(args.config)
+        instances_config = config['instances']
+        sync_groups_config = config.get('sync_groups', [])
+        for item in instances_config:
+            if isinstance(item, dict):
+                item.setdefault('master', args.master)
+
+    # Check and import the instances and their VIPs
+    instances = []
+    for item in instances_config:
+        instance_check(instances,item,interfaces)
+
+    # Check the instances do not conflict with each other
+    instance_names = set()
+    instance_vrids = set()
+    instance_vips  = set()
+    for instance in instances:
+        if instance['name'] in instance_names:
+            raise ConfigError("The instance name %s is used more than once" % instance['name'])
+        instance_names.add(instance['name'])
+        if (instance['track_iface'], instance['virtual_router_id']) in instance_vrids:
+            raise ConfigError("The vrid %d is used more than once on the iface %s" % (instance['virtual_router_id'],
+                                                                                     instance['track_iface']))
+        instance_vrids.add((instance['track_iface'], instance['virtual_router_id']))
+        for vip in instance['virtual_ipaddresses'] + instance['virtual_ipaddresses_excluded']:
+            if (vip['addr'], vip['iface']) in instance_vips:
+                raise ConfigError("The VIP %s/%s is used more than once" % (vip['addr'], vip['iface']))
+            instance_vips.add((vip['addr'], vip['iface']))
+
+    # Check the routes do not conflict with each other or the VIPs
+    overlaps = routes_check(instances)
+    for route, overlap in overlaps[:10]:
+        print "WARNING: The route to %s/%s overlaps the route to %s/%s" % (overlap['addr'], overlap['mask'],
+                                                                          route['addr'], route['mask'])
+    if len(overlaps) > 10:
+        print "WARNING: %d more routes overlap another route" % (len(overlaps) - 10)
+
+    # Use the default auth pass for any instance without one
+    for instance in instances:
+        if instance['auth_pass'] is None:
+            instance['auth_pass'] = args.auth_pass
+        if instance['auth_pass'] is None:
+            print 'WARNING: Using this container without a set auth pass will make this container insecure.'
+            instance['auth_pass'] = '12345678'
+        # Anything else would end the auth_pass early or break the rendered configuration. A number in YAML must be
+        # quoted to be read as a string
+        auth_pass = instance['auth_pass']
+        if not isinstance(auth_pass, basestring) or not re.match(r'^[^\s{}"#!]+$', auth_pass):
+            errormsg = "The auth_pass of instance %s must be a string without whitespace, braces, quotes, '#' or" % (
+                instance['name'])
+            errormsg += " '!'"
+            raise ConfigError(errormsg)
+
+    # Check and import the sync groups
+    sync_groups = []
+    grouped_instances = set()
+    if not isinstance(sync_groups_config, list):
+        raise ConfigError("The sync_groups in the configuration file must be a list")
+    for item in sync_groups_config:
+        if not isinstance(item, dict) or not isinstance(item.get('instances'), list) or not item['instances']:
+            raise ConfigError("The sync group %s does not contain a list of instances" % item)
+        group_name = str(item.get('name', 'group_%d' % (len(sync_groups) + 1)))
+        if not re.match(r'^[A-Za-z0-9_.-]+$', group_name):
+            raise ConfigError("The sync group name %s may only contain letters, numbers, '_', '.' and '-'" % group_name)
+        names = [str(name) for name in item['instances']] # As the instance names are
+        for name in names:
+            if name not in instance_names:
+                raise ConfigError("The sync group %s refers to an unknown instance %s" % (group_name, name))
+            if name in grouped_instances:
+                raise ConfigError("The instance %s is in more than one sync group" % name)
+            grouped_instances.add(name)
+        sync_groups.append({ 'name'      : group_name,
+                             'instances' : names,
+                           })
+
+    return instances, sync_groups
+
+def reload_template(child,args,template_dict,stats):
+    """Re-read the configuration file given in `args` and render it for `template_dict` into a temporary file. Only if
+    the result differs from the configuration keepalived is running is it moved into place and `child` sent SIGHUP.
+
+    `stats` counts the reloads, skipped reloads and failed reloads."""
+    import netifaces
+    with reload_lock: # --watch and --flap-dampening may both reload at once
+        started = time.time()
+        try:
+            instances, sync_groups = load_instances(args,set(netifaces.interfaces()))
+        except ConfigError as e:
+            stats['failed'] += 1
+            print "%s, keeping the current configuration" % e
+            return
+
+        if template_dict['context']['dampening'] is not None:
+            template_dict['context']['dampening'].apply(instances)
+        if template_dict['context']['monitor'] is not None:
+            template_dict['context']['monitor'].expect(instances)
+        context = dict(template_dict['context'], instances=instances, sync_groups=sync_groups)
+        temp_path = template_dict['path'] + '.tmp'
+        try:
+            with open(temp_path,'w') as f:
+                stream = template_dict['template'].stream(context)
+                stream.enable_buffering(100) # Write in batches of 100 chunks
+                stream.dump(f,'utf8')
+            if filecmp.cmp(temp_path,template_dict['path'],shallow=False):
+                os.remove(temp_path)
+                stats['skipped'] += 1
+                print "The configuration is unchanged, not reloading keepalived (%d skipped so far)" % stats['skipped']
+                return
+            if template_dict['user'] is not None: # Not when rendered elsewhere, as the tests do
+                os.chown(temp_path,template_dict['uid'],template_dict['gid'])
+            os.chmod(temp_path,template_dict['mode'])
+            os.rename(temp_path,template_dict['path']) # rename() is atomic, keepalived will never read a partial file
+        except (IOError, OSError) as e:
+            stats['failed'] += 1
+            print "The new configuration could not be written (returned %s), keeping the current configuration" % e
+            return
+
+        try:
+            signalled = child.send_signal(SIGHUP)
+        except OSError as e:
+            stats['failed'] += 1
+            errormsg = "keepalived could not be sent SIGHUP (returned %s), it will read the new configuration" % e
+            errormsg += " when it restarts"
+            print errormsg
+            return
+        stats['reloads'] += 1
+        if signalled:
+            errormsg = "Reloaded keepalived with the new configuration in %.1fms" % ((time.time() - started) * 1000)
+        else:
+            errormsg = "Wrote the new configuration in %.1fms, keepalived will read it when it is restarted" % (
+                (time.time() - started) * 1000)
+        errormsg += " (%d reloads, %d skipped, %d failed)" % (stats['reloads'], stats['skipped'], stats['failed'])
+        print errormsg
+
+def watch_config(child,args,template_dict):
+    """Check the configuration file given in `args` for changes every --watch-interval seconds, and reload keepalived
+    when it does change. This is intended to be run in its own thread."""
+    stats = { 'reloads' : 0, 'skipped' : 0, 'failed' : 0 }
+    last_seen = None
+    while True:
+        try:
+            config_stat = os.stat(args.config)
+            seen = (config_stat.st_ino, config_stat.st_mtime, config_stat.st_size)
+        except OSError:
+            seen = None # The file may be part way through being replaced, look again next time
+        if seen is not None:
+            if last_seen is not None and seen != last_seen:
+                reload_template(child,args,template_dict,stats)
+            last_seen = seen
+        time.sleep(args.watch_interval)
+
+def watch_dampening(child,args,template_dict,dampening):
+    """Reload keepalived whenever `dampening` suppresses or releases an instance, or an instance it holds back has
+    decayed below reuse, rather than leaving the change until keepalived is next started. This is intended to be run
+    in its own thread."""
+    stats = { 'reloads' : 0, 'skipped' : 0, 'failed' : 0 }
+    while True:
+        dampening.wait_for_change()
+        reload_template(child,args,template_dict,stats)
+
+def apply_failover_profile(args):
+    """Fill in the timings in `args` that were not given explicitly from the --failover-profile."""
+    for key, value in failover_profiles[args.failover_profile].iteritems():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+def failover_times(advert_int,priority,check_interval=None,check_fall=None,check_timeout=None,check_daemon=False,
+                   check_cache=False):
+    """Return a tuple of the worst case seconds for a backup with `priority` to detect that the master has failed, for
+    a master to detect that its check has failed (None without a check) and for a backup to have taken over after
+    either.
+
+    A backup takes over after missing three adverts plus a skew of up to one advert interval that is longer for lower
+    priorities. A check fails once `check_fall` checks in a row fail, and the first of those may start up to one
+    `check_interval` after the failure. With `check_daemon` keepalived may read the result up to another check
+    interval after the daemon wrote it, and with `check_cache` a check may use a result up to another check interval
+    old. Once a check fails the master drops its priority, and a backup takes over on its next advert."""
+    node = 3 * advert_int + (256 - priority) * advert_int / 256.0
+    if check_interval is None:
+        return node, None, node
+    check = check_fall * check_interval + check_timeout
+    if check_daemon:
+        check += check_interval
+    if check_cache:
+        check += check_interval
+    return node, check, max(node, check + advert_int)
+
+def print_startup_timing(startup_timing):
+    """Print how long it took to start keepalived, and how long each phase in `startup_timing` took."""
+    print "Startup took %.1fms to spawn keepalived:" % ((time.time() - startup_started) * 1000)
+    for phase, seconds in startup_timing:
+        print "    %-40s %8.1fms" % (phase, seconds * 1000)
+    sys.stdout.flush()
+
 def run_command_with_timeout(cmd, timeout_sec):
     """Execute `cmd` in a subprocess and enforce timeout `timeout_sec` seconds.
  
@@ -110,9 +1467,68 @@ def run_command_with_timeout(cmd, timeout_sec):
     # Process completed naturally - return exit code
     return proc.returncode
 
-# Register atexit
-atexit.register(cleanup,None)
-    
+def preflight_override_check(path,timeout):
+    """Run the override check script at `path` once to make sure it works. Returns an error message, or None if it
+    ran within `timeout` seconds."""
+    try:
+        run_command_with_timeout([path],timeout)
+    except SubprocessTimeoutError as e:
+        return "Command %s did not finish in %d seconds" % (path, timeout)
+    except OSError as e:
+        return "Command %s could not be run (returned %s)" % (path, e)
+    return None
+
+def preflight_urls(urls,timeout,quorum):
+    """Request each of the `urls` once to make sure at least `quorum` of them can be reached. Returns an error
+    message, or None if enough of them could be reached."""
+    import requests     # Allows you to perform requests (like curl)
+    from requests.exceptions import ConnectionError, SSLError
+                        # Handle request ConenctionError exceptions gracefully.
+    connected = 0
+    for url in urls:
+        try:
+            requests.get(url,timeout=timeout)
+            connected += 1
+        except ConnectionError as e:
+            print "WARNING: The URL %s will not estasblish a connection (returned %s)" % (url, e)
+        except SSLError as e:
+            print "WARNING: The URL %s did not pass SSL vertification (returned %s)" % (url, e)
+        except:
+            e = sys.exc_info()[0]
+            print "WARNING: Unrecognised exception occured, was unable to request %s (returned %s)" % (url, e)
+    if connected < quorum:
+        return "Only %d of the URLs provided could be requested but the quorum is %d" % (connected, quorum)
+    return None
+
+def preflight_haproxy_socket(path,timeout):
+    """Ask the HAProxy stats socket at `path` for its information to make sure it works. Returns an error message, or
+    None if it answered within `timeout` seconds."""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return "The provided path %s for the HAProxy socket is not a socket" % path
+        stats_socket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        stats_socket.settimeout(timeout)
+        stats_socket.connect(path)
+        stats_socket.sendall('show info\n')
+        stats_info = stats_socket.recv(4096)
+        stats_socket.close()
+    except (OSError, socket.error) as e:
+        return "The HAProxy socket %s could not be queried (returned %s)" % (path, e)
+    if 'Name:' not in stats_info:
+        return "The socket %s does not appear to be a HAProxy stats socket" % path
+    return None
+
+class Preflight(Thread):
+    """Runs one of the preflight functions, so that with --fast-start it can run while the templates are rendered."""
+    def __init__(self,preflight,*preflight_args):
+        Thread.__init__(self)
+        self.daemon = True # Do not wait for a preflight that has missed its deadline when exiting
+        self.preflight = preflight
+        self.preflight_args = preflight_args
+        self.error = None
+    def run(self):
+        self.error = self.preflight(*self.preflight_args)
+
 ########################################################################################################################
 # ARGUMENT PARSER                                                                                                      #
 # This is where you put the Argument Parser lines                                                                      #
@@ -140,35 +1556,74 @@ argparser.add_argument('--exclude','-x',
                        action='append',
                        nargs='?',
                        help='Any virtual IP(s) and iface(s) you want to be excluded in the form 203.0.113.0/24/eth0')
+argparser.add_argument('--route','-a',
+                       action='append',
+                       help='A virtual route to add and remove along with the VIPs, may be given more than once, in the'
+                            ' form "[src 203.0.113.1 to] 198.51.100.0/24 [via 203.0.113.254 [or 203.0.113.253]] [dev'
+                            ' eth0]" or "blackhole 198.51.100.0/24"')
+argparser.add_argument('--route-file','-j',
+                       action='store',
+                       help='A file of virtual routes, one per line in the same form as --route')
 argparser.add_argument('--check-interval','-i',
                        action='store',
                        nargs='?',
                        type=int,
-                       default=2,
-                       help='The interval the check script should repeat, (default 2)')
+                       help='The interval the check script should repeat, (default 2, or 1 with --failover-profile'
+                            ' fast)')
 argparser.add_argument('--check-rise','-r',
                        action='store',
                        nargs='?',
                        type=int,
-                       default=2,
                        help='The amount of sucessful checks required to restore a fault, (default 2)')
 argparser.add_argument('--check-fall','-f',
                        action='store',
                        nargs='?',
                        type=int,
-                       default=2,
-                       help='The amount of failed checks required to fault, (default 2)')
+                       help='The amount of failed checks required to fault, (default 2, or 1 with --failover-profile'
+                            ' fast)')
+argparser.add_argument('--advert-int','-U',
+                       action='store',
+                       type=int,
+                       help='The interval in seconds between VRRP advertisements. A backup takes over once it has'
+                            ' missed three of them, (default 1)')
+helptext = 'Set the advert interval, check interval, rise, fall and check timeout together. standard is advert_int'
+helptext += ' 1, a check every 2 seconds with rise 2 and fall 2 and a timeout of the check interval. fast is advert_int'
+helptext += ' 1, a check every second with rise 2 and fall 1 and a timeout of 0.5 seconds. Any of these that are'
+helptext += ' given explicitly override the profile. The worst case failover time is printed on startup, (default'
+helptext += ' standard)'
+argparser.add_argument('--failover-profile','-O',
+                       action='store',
+                       choices=sorted(failover_profiles),
+                       default='standard',
+                       help=helptext)
 argparser.add_argument('track_iface',
                        action='store',
+                       nargs='?',
                        help='The network interface this VRRP will broadcast multicast traffic over')
 argparser.add_argument('priority',
                        action='store',
                        type=int,
+                       nargs='?',
                        help='The priority this keepalived instance should run at in this VRRP.')
 argparser.add_argument('include',
                        action='store',
-                       nargs='+',
+                       nargs='*',
                        help='The virtual IP(s) and iface(s) you will be using  in the form 203.0.113.0/24/eth0')
+helptext = 'Instead of track_iface, priority and include, read any number of VRRP instances and sync groups from this'
+helptext += ' JSON or YAML file. --master and --auth-pass are used as the defaults for each instance.'
+argparser.add_argument('--config','-C',
+                       action='store',
+                       help=helptext)
+helptext = 'Watch the --config file and when it changes, reload keepalived without restarting it. keepalived is only'
+helptext += ' reloaded if the new configuration is valid and differs from the current one.'
+argparser.add_argument('--watch','-R',
+                       action='store_true',
+                       help=helptext)
+argparser.add_argument('--watch-interval','-I',
+                       action='store',
+                       type=float,
+                       default=2,
+                       help='The interval in seconds --watch checks the --config file for changes, (default 2)')
 
 argparser_check_script = argparser.add_mutually_exclusive_group()
 helptext = 'This is where you can provide a custom script to this container to check if this instance should be' 
@@ -178,243 +1633,802 @@ argparser_check_script.add_argument('--override-check','-o',
                        nargs='?',
                        help=helptext)
 helptext = 'This enables the default checking script which will demote this instance if it cannot get a 200'
-helptext += ' return code from the given URL.'
+helptext += ' return code from the given URL. May be given more than once to check several URLs concurrently.'
 argparser_check_script.add_argument('--enable-check','-e',
-                       action='store',
+                       action='append',
                        nargs='?',
                        help=helptext)
+helptext = 'This enables checking the servers of HAProxy through its stats socket at the given path, which must be'
+helptext += ' mounted into this container. The check runs as a daemon with a persistent connection to the socket.'
+argparser_check_script.add_argument('--haproxy-socket','-H',
+                       action='store',
+                       help=helptext)
+argparser.add_argument('--check-backend','-b',
+                       action='append',
+                       help='Only consider the servers in this HAProxy backend for --haproxy-socket, may be given more'
+                            ' than once, (default all backends)')
+argparser.add_argument('--check-min-capacity','-c',
+                       action='store',
+                       type=int,
+                       default=1,
+                       help='The percentage of servers that must be up in every backend for --haproxy-socket to'
+                            ' pass, (default 1)')
+helptext = 'The priority to add to this instance when all servers are up for --haproxy-socket. It is added in'
+helptext += ' --check-weight-steps steps as servers come up, so the instance with the most healthy capacity becomes'
+helptext += ' the master, (default 0)'
+argparser.add_argument('--check-weight','-w',
+                       action='store',
+                       type=int,
+                       default=0,
+                       help=helptext)
+argparser.add_argument('--check-weight-steps','-W',
+                       action='store',
+                       type=int,
+                       default=4,
+                       help='The number of steps --check-weight is added in, (default 4)')
+argparser.add_argument('--check-quorum','-q',
+                       action='store',
+                       default='all',
+                       help='How many of the --enable-check URLs must pass, either a number, "all" or "any", (default all)')
+argparser.add_argument('--check-timeout','-t',
+                       action='store',
+                       type=float,
+                       help='The deadline in seconds for each check of the --enable-check URLs or --haproxy-socket,'
+                            ' or each run of the --override-check script, which is killed once it is reached. This can'
+                            ' not be more than the check interval, (default the check interval, or 0.5 with'
+                            ' --failover-profile fast)')
+argparser.add_argument('--check-status','-s',
+                       action='append',
+                       type=int,
+                       help='A status code the --enable-check URLs may return to pass, may be given more than once,'
+                            ' (default 200)')
+argparser.add_argument('--check-match','-g',
+                       action='store',
+                       help='A regular expression that must be found in the body returned by the --enable-check URLs')
+helptext = 'Run the default checking script as a persistent daemon that keeps a connection open to the given URL.'
+helptext += ' keepalived then only reads the last result from %s instead of starting a new check each' % check_state_file
+helptext += ' interval. Requires --enable-check.'
+argparser.add_argument('--check-daemon','-d',
+                       action='store_true',
+                       help=helptext)
+helptext = 'Share the result of each probe of an --enable-check URL or the --haproxy-socket through'
+helptext += ' %s, so that every instance and container on this host using the same /ka-data' % probe_cache_path
+helptext += ' probes each target only once every --check-interval seconds'
+argparser.add_argument('--check-cache','-Q',
+                       action='store_true',
+                       help=helptext)
+
+helptext = 'Start keepalived sooner by running the preflight checks while the templates are rendered, and caching the'
+helptext += ' compiled templates in %s' % template_cache_path
+argparser.add_argument('--fast-start','-F',
+                       action='store_true',
+                       help=helptext)
+argparser.add_argument('--preflight-timeout','-P',
+                       action='store',
+                       type=float,
+                       default=30,
+                       help='The deadline in seconds for the checks performed before starting keepalived, (default 30)')
+argparser.add_argument('--log-format','-L',
+                       action='store',
+                       choices=['plain','json'],
+                       default='plain',
+                       help='The format keepalived\'s log messages are written in. json writes a JSON object per line'
+                            ' with VRRP state changes and check script results parsed into events, (default plain)')
+argparser.add_argument('--startup-timing','-T',
+                       action='store_true',
+                       help='Report how long each phase of starting keepalived took')
+helptext = 'The number of notify hooks that can run at once. The hooks are scripts in %s' % scripts_path
+helptext += ' named notify_master, notify_backup or notify_fault, which are run when a VRRP instance or sync group'
+helptext += ' enters that state, or notify, which is run for every state. They are given the same arguments'
+helptext += ' keepalived gives a notify script, (default 2)'
+argparser.add_argument('--notify-workers','-k',
+                       action='store',
+                       type=int,
+                       default=2,
+                       help=helptext)
+argparser.add_argument('--notify-timeout','-N',
+                       action='store',
+                       type=float,
+                       default=30,
+                       help='The seconds a notify hook may run for before it is killed, (default 30)')
+helptext = 'Replace this script with keepalived once it has been configured, so that no Python is left running for'
+helptext += ' the life of the container. keepalived then writes its own output and handles its own signals. This can'
+helptext += ' not be used with --supervise, --watch, --metrics-port, --log-format json, --flap-dampening,'
+helptext += ' --vrrp-monitor or notify hooks'
+argparser.add_argument('--exec','-E',
+                       action='store_true',
+                       dest='exec_keepalived',
+                       help=helptext)
+helptext = 'Restart keepalived in place when it exits, instead of exiting and leaving the container to be restarted.'
+helptext += ' The configuration that was already rendered is reused, and each restart is delayed by an exponential'
+helptext += ' backoff with jitter'
+argparser.add_argument('--supervise','-S',
+                       action='store_true',
+                       help=helptext)
+argparser.add_argument('--restart-limit','-l',
+                       action='store',
+                       type=int,
+                       default=5,
+                       help='With --supervise, exit once keepalived has exited more than this many times within'
+                            ' --restart-window seconds, (default 5)')
+argparser.add_argument('--restart-window','-Y',
+                       action='store',
+                       type=float,
+                       default=60,
+                       help='The window in seconds --restart-limit applies to, (default 60)')
+argparser.add_argument('--restart-backoff','-B',
+                       action='store',
+                       type=float,
+                       default=1,
+                       help='The delay in seconds before the first restart, doubling for each further exit within'
+                            ' --restart-window, (default 1)')
+argparser.add_argument('--restart-backoff-max','-X',
+                       action='store',
+                       type=float,
+                       default=30,
+                       help='The longest delay in seconds before a restart, (default 30)')
+argparser.add_argument('--metrics-port','-M',
+                       action='store',
+                       type=int,
+                       help='Serve Prometheus metrics at /metrics on this port, covering VRRP state, check results'
+                            ' and latency and how quickly keepalived\'s output is relayed, (default disabled)')
+argparser.add_argument('--metrics-address','-A',
+                       action='store',
+                       default='127.0.0.1',
+                       help='The address the metrics are served on, (default 127.0.0.1)')
+
+helptext = 'Stop a VRRP instance that keeps changing state from taking over again until it has been stable for a'
+helptext += ' while, as in BGP route flap dampening. Each state change adds %d to the instance\'s' % flap_penalty
+helptext += ' penalty, which decays with --flap-half-life. The state changes are kept in %s so' % dampening_state_path
+helptext += ' that they survive restarts'
+argparser.add_argument('--flap-dampening','-D',
+                       action='store_true',
+                       help=helptext)
+argparser.add_argument('--flap-half-life','-G',
+                       action='store',
+                       type=float,
+                       default=900,
+                       help='The seconds it takes for the flap penalty to halve, (default 900)')
+argparser.add_argument('--flap-suppress','-J',
+                       action='store',
+                       type=int,
+                       default=2000,
+                       help='The penalty at which an instance is suppressed, it then starts as a backup and does not'
+                            ' preempt, (default 2000)')
+argparser.add_argument('--flap-reuse','-K',
+                       action='store',
+                       type=int,
+                       default=750,
+                       help='The penalty a suppressed instance must decay below before it preempts again. Above this'
+                            ' penalty an instance waits out a preempt delay before preempting, (default 750)')
+
+helptext = 'Listen for VRRP advertisements on the interfaces of the instances. Before keepalived is started, any other'
+helptext += ' router using the VRID of an instance with a different password, addresses or advert interval stops the'
+helptext += ' container from starting. While keepalived runs, the routers seen, their priorities and the jitter of'
+helptext += ' their advertisements are logged and served as metrics'
+argparser.add_argument('--vrrp-monitor','-V',
+                       action='store_true',
+                       help=helptext)
+argparser.add_argument('--vrrp-listen','-Z',
+                       action='store',
+                       type=float,
+                       help='The seconds to listen for VRRP advertisements before keepalived is started, (default three'
+                            ' advert intervals and a second, the longest a backup waits for a master)')
+
+def parse_arguments(argv=None):
+    """Parse the command line arguments `argv`, or sys.argv if they are not given."""
+    try:
+        return argparser.parse_args(argv)
+    except SystemExit:
+        pass
+        sys.exit(0) # This should be a return 0 to prevent the container from restarting
 
-try:
-    args = argparser.parse_args()
-except SystemExit:
-    pass
-    sys.exit(0) # This should be a return 0 to prevent the container from restarting
-    
 ########################################################################################################################
 # ARGUMENT VERIRIFCATION                                                                                               #
 # This is where you put any logic to verify the arguments, and failure messages                                        #
 ########################################################################################################################
-auth_pass = args.auth_pass
-if auth_pass is None:
-    print 'WARNING: Using this container without a set auth pass will make this container insecure.'
-    auth_pass = '12345678'
-
-vrid  = args.vrid
-if vrid is None:
-    print 'WARNING: Not setting a vrid could result in a conflict. Please specify a vrid to avoid possible conflicts'
-    vrid = 1
-    
-# Check if the track_iface is a valid iface
-if args.track_iface not in netifaces.interfaces():
-    print "The iface %s does not appear to be a valid interface on this host, terminating..." % args.track_iface
-    sys.exit(0) # This should be a return 0 to prevent the container from restarting.
-
-vips = []
-# Check and import the included VIPs
-for vip in args.include:
-    vip_check(vips,vip,False)
-    
-# Check and import the excluded VIPs:
-if args.exclude is not None:
-    for vip in args.exclude:
-        vip_check(vips,vip,True)
-
-# Check that they're exclusvely active
-check_script_enabled = False
-if args.override_check is not None or args.enable_check is not None:
-    # At least one is active
-    check_script_enabled = True
-    # We should check that both are not enabled
-    if args.override_check is not None and args.enable_check is not None:
-        errormsg = "Both --override-check and --enable-check are enabled. This should never get here as the argparser"
-        errormsg += " library should catch this errorcase"
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.        
-
-# Check the override check script
-if args.override_check is not None:
-    if not os.path.isfile(scripts_path + args.override_check):
-        print "The provided file %s for the override_check is not a file, terminating..." % args.override_check
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.        
-    # Add execute permissions to the override check script
-    try:
-        current_mask = stat.S_IMODE(os.stat(scripts_path + args.override_check).st_mode)
-        os.chmod(scripts_path + args.override_check, current_mask | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH )
-        # Equivelent to chmod +x
-    except OSError as e:
-        errormsg = "The file %s could not be chmoded" % (scripts_path + args.override_check)
-        errormsg += "  (returned %s), terminating..." %  e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
-    # Attempt to execute it
-    timeout = 30 # Give it 30 seconds to attempt to check script
-    try:
-        run_command_with_timeout([scripts_path + args.override_check],timeout)
-    except SubprocessTimeoutError as e:
-        print "Command %s did not finish in %d seconds, terminating..." % timeout, (scripts_path + args.override_check)
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
-   
-# Check the default script is working
-check_url_parsed = None # Set default
-if args.enable_check is not None:
-    check_url_parsed = urlparse.urlparse(args.enable_check,'http')
-    try:
-        check_url_request = requests.get(urlparse.urlunparse(check_url_parsed))
-    except ConnectionError as e:
-        print "The URL provided will not estasblish a connection (returned %s), terminating..." % e
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
-    except SSLError as e:
-        print "The URL provided did not pass SSL vertification (returned %s), terminating..." % e
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
-    except:
-        e = sys.exc_info()[0]
-        print "Unrecognised exception occured, was unable to perform test request (returned %s), terminating..." % e
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+def check_arguments(args):
+    """Check the arguments `args` that stand alone, raising ConfigError if any are not valid."""
+    if args.preflight_timeout <= 0:
+        raise ConfigError("The preflight timeout %s must be greater than 0" % args.preflight_timeout)
+
+    if args.supervise:
+        if args.restart_limit < 0:
+            raise ConfigError("The restart limit %s must not be negative" % args.restart_limit)
+        if args.restart_window <= 0:
+            raise ConfigError("The restart window %s must be greater than 0" % args.restart_window)
+        if args.restart_backoff < 0 or args.restart_backoff_max < args.restart_backoff:
+            errormsg = "The restart backoff %s must not be negative or more than" % args.restart_backoff
+            errormsg += " the maximum restart backoff %s" % args.restart_backoff_max
+            raise ConfigError(errormsg)
+
+    if args.advert_int < 1 or args.advert_int > 255:
+        raise ConfigError("The advert interval %s must be between 1 and 255 seconds" % args.advert_int)
+    for key in ('check_interval','check_rise','check_fall'):
+        if getattr(args, key) < 1:
+            raise ConfigError("The %s %s must be at least 1" % (key.replace('_',' '), getattr(args, key)))
+
+    if args.metrics_port is not None and (args.metrics_port < 1 or args.metrics_port > 65535):
+        raise ConfigError("The metrics port %s must be between 1 and 65535" % args.metrics_port)
+
+    if args.flap_dampening:
+        if args.flap_half_life <= 0:
+            raise ConfigError("The flap half life %s must be greater than 0" % args.flap_half_life)
+        if args.flap_reuse <= 0 or args.flap_suppress <= args.flap_reuse:
+            errormsg = "The flap reuse penalty %s must be greater than 0 and less than" % args.flap_reuse
+            errormsg += " the flap suppress penalty %s" % args.flap_suppress
+            raise ConfigError(errormsg)
+
+    if args.vrrp_monitor:
+        if args.vrrp_listen is None:
+            args.vrrp_listen = 3 * args.advert_int + 1
+        if args.vrrp_listen <= 0 or args.vrrp_listen >= args.preflight_timeout:
+            errormsg = "The VRRP listen time %s must be greater than 0 and less than" % args.vrrp_listen
+            errormsg += " the preflight timeout %s" % args.preflight_timeout
+            raise ConfigError(errormsg)
+
+    if args.watch and args.config is None:
+        raise ConfigError("The --watch flag can only be used with --config")
+    if args.watch_interval <= 0:
+        raise ConfigError("The watch interval %s must be greater than 0" % args.watch_interval)
+
+def load_check_script(args,instances):
+    """Check the arguments `args` for the check script, returning a tuple of the check script for the template and
+    the preflight checks that make sure it works. `instances` are only used to warn about priorities that are too
+    high. Raises ConfigError if the arguments are not valid."""
+    # Check that they're exclusvely active
+    check_script_enabled = False
+    if args.override_check is not None or args.enable_check is not None or args.haproxy_socket is not None:
+        # At least one is active
+        check_script_enabled = True
+        # We should check that both are not enabled
+        if args.override_check is not None and args.enable_check is not None:
+            errormsg = "Both --override-check and --enable-check are enabled. This should never get here as the"
+            errormsg += " argparser library should catch this errorcase"
+            raise ConfigError(errormsg)
+
+    if args.check_daemon and args.enable_check is None:
+        raise ConfigError("The --check-daemon flag can only be used with --enable-check")
+    if args.check_cache and args.enable_check is None and args.haproxy_socket is None:
+        raise ConfigError("The --check-cache flag can only be used with --enable-check or --haproxy-socket")
+
+    check_timeout = args.check_timeout if args.check_timeout is not None else float(args.check_interval)
+    if check_timeout <= 0:
+        raise ConfigError("The check timeout %s must be greater than 0" % check_timeout)
+    if check_timeout > args.check_interval:
+        errormsg = "The check timeout %s must not be more than the check interval %s, or a check" % (check_timeout,
+                                                                                                   args.check_interval)
+        errormsg += " could still be running when the next one starts"
+        raise ConfigError(errormsg)
+
+    # Check the options for the default script
+    check_urls = []
+    if args.enable_check is not None:
+        for url in args.enable_check:
+            if url is None:
+                raise ConfigError("The --enable-check flag was provided without a URL")
+            check_url = urlparse.urlunparse(urlparse.urlparse(url,'http')) # Default to http
+            if check_url not in check_urls:
+                check_urls.append(check_url)
+
+        if args.check_quorum == 'all':
+            check_quorum = len(check_urls)
+        elif args.check_quorum == 'any':
+            check_quorum = 1
+        else:
+            try:
+                check_quorum = int(args.check_quorum)
+            except ValueError:
+                raise ConfigError("The quorum %s is not a number, \"all\" or \"any\"" % args.check_quorum)
+            if check_quorum < 1 or check_quorum > len(check_urls):
+                raise ConfigError("The quorum %d must be between 1 and %d" % (check_quorum, len(check_urls)))
+
+        if args.check_match is not None:
+            if '"' in args.check_match:
+                raise ConfigError("The check match %s can not contain a double quote" % args.check_match)
+            try:
+                re.compile(args.check_match)
+            except re.error as e:
+                raise ConfigError("The check match %s is not a valid regular expression (returned %s)" %
+                                  (args.check_match, e))
+
+    # Check the options for the HAProxy stats socket
+    check_weights = []
+    if args.haproxy_socket is not None:
+        if args.check_min_capacity < 0 or args.check_min_capacity > 100:
+            raise ConfigError("The check min capacity %d must be between 0 and 100" % args.check_min_capacity)
+        if args.check_weight < 0 or args.check_weight > 254:
+            raise ConfigError("The check weight %d must be between 0 and 254" % args.check_weight)
+        if args.check_weight_steps < 1 or args.check_weight_steps > 100:
+            raise ConfigError("The check weight steps %d must be between 1 and 100" % args.check_weight_steps)
+        for instance in instances:
+            if instance['priority'] + args.check_weight > 254:
+                errormsg = "WARNING: The priority %d of instance %s plus the check weight %d is over 254," % \
+                           (instance['priority'], instance['name'], args.check_weight)
+                errormsg += " keepalived will limit this instance to a priority of 254"
+                print errormsg
+
+        # Split the weight into steps, each of which is added once that percentage of servers are up
+        if args.check_weight > 0:
+            for step in range(1, args.check_weight_steps + 1):
+                check_weights.append({ 'name'         : 'check_capacity_%d' % step,
+                                       'min_capacity' : -(-100 * step // args.check_weight_steps), # Round up
+                                       'weight'       : args.check_weight * step // args.check_weight_steps -
+                                                        args.check_weight * (step - 1) // args.check_weight_steps,
+                                     })
+    elif args.check_weight != 0 or args.check_backend is not None:
+        raise ConfigError("The --check-weight and --check-backend flags can only be used with --haproxy-socket")
+
+    # Check the override check script
+    if args.override_check is not None:
+        if not os.path.isfile(scripts_path + args.override_check):
+            raise ConfigError("The provided file %s for the override_check is not a file" % args.override_check)
+        # Add execute permissions to the override check script
+        try:
+            current_mask = stat.S_IMODE(os.stat(scripts_path + args.override_check).st_mode)
+            os.chmod(scripts_path + args.override_check, current_mask | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH )
+            # Equivelent to chmod +x
+        except OSError as e:
+            raise ConfigError("The file %s could not be chmoded (returned %s)" % (scripts_path + args.override_check,
+                                                                                   e))
+
+    # Check the default script is working
+    check_argv = None # Set default
+    preflight = []
+    if args.override_check is not None:
+        preflight.append(Preflight(preflight_override_check,scripts_path + args.override_check,
+                                   args.preflight_timeout))
+    if args.enable_check is not None:
+        preflight.append(Preflight(preflight_urls,check_urls,check_timeout,check_quorum))
+
+        # Build the arguments for check_haproxy
+        check_argv = ['--quorum',str(check_quorum),'--timeout',str(check_timeout)]
+        for check_status in (args.check_status if args.check_status is not None else [200]):
+            check_argv += ['--status',str(check_status)]
+        if args.check_match is not None:
+            check_argv += ['--match',args.check_match]
+        check_argv += check_urls
+
+    # Check the HAProxy stats socket is working
+    if args.haproxy_socket is not None:
+        preflight.append(Preflight(preflight_haproxy_socket,args.haproxy_socket,check_timeout))
+
+        # Build the arguments for check_haproxy
+        check_argv = ['--socket',args.haproxy_socket,'--timeout',str(check_timeout),
+                      '--min-capacity',str(args.check_min_capacity)]
+        for check_backend in (args.check_backend if args.check_backend is not None else []):
+            check_argv += ['--backend',check_backend]
+
+    # Share the probes with every other check of the same target, a result is used for up to a check interval
+    if args.check_cache:
+        check_argv = ['--cache',probe_cache_path,'--cache-ttl',str(args.check_interval)] + check_argv
+
+    # Setup the check script variables
+    check_script = { 'enabled'  : check_script_enabled,
+                     'path'     : scripts_path + args.override_check if args.override_check is not None else None,
+                     'interval' : args.check_interval, # int
+                     'rise'     : args.check_rise, # int
+                     'fall'     : args.check_fall, # int
+                     'urls'     : check_urls if args.enable_check is not None else None,
+                     'argv'     : check_argv, # Arguments for check_haproxy
+                     'args'     : ' '.join(pipes.quote(arg) for arg in check_argv) if check_argv is not None else None,
+                     'daemon'   : args.check_daemon or args.haproxy_socket is not None, # bool
+                     'weights'  : check_weights, # Additional weighted scripts
+                     'state_file' : check_state_file,
+                     'max_age'  : args.check_interval * 3, # A result older than this means the daemon is not running
+                     'timeout'  : check_timeout,
+                     'cache'    : args.check_cache, # bool
+                   }
+    return check_script, preflight
+
+def load_notify_hooks(args):
+    """Find the notify hooks and add execute permissions to them, returning a dict of the hook for each state (None
+    for the hook run for every state). Raises ConfigError if the arguments `args` for them are not valid."""
+    notify_hooks = {}
+    for state in notify_states + [None]:
+        hook = scripts_path + ('notify_%s' % state.lower() if state is not None else 'notify')
+        if not os.path.isfile(hook):
+            continue
+        try:
+            current_mask = stat.S_IMODE(os.stat(hook).st_mode)
+            os.chmod(hook, current_mask | stat.S_IEXEC | stat.S_IXGRP | stat.S_IXOTH ) # Equivelent to chmod +x
+        except OSError as e:
+            raise ConfigError("The file %s could not be chmoded (returned %s)" % (hook, e))
+        notify_hooks[state] = hook
+    if notify_hooks and args.notify_workers < 1:
+        raise ConfigError("The number of notify workers %s must be at least 1" % args.notify_workers)
+    if notify_hooks and args.notify_timeout <= 0:
+        raise ConfigError("The notify timeout %s must be greater than 0" % args.notify_timeout)
+    return notify_hooks
+
+def configure(args):
+    """Check all of the arguments `args`, returning a tuple of the context for the keepalived template, the
+    preflight checks to run before starting keepalived and the notify hooks. Raises ConfigError if they are not
+    valid."""
+    import netifaces    # Slow to import, so only imported once it is needed
+
+    apply_failover_profile(args)
+    check_arguments(args)
+
+    # Check and import the instances and their VIPs
+    interfaces = set(netifaces.interfaces()) # Look the interfaces up once as they are checked for every VIP
+    instances, sync_groups = load_instances(args,interfaces)
+
+    check_script, preflight = load_check_script(args,instances)
+    notify_hooks = load_notify_hooks(args)
+
+    # Hold back any instance that has been changing state, as recorded before this restart
+    dampening = None
+    if args.flap_dampening:
+        dampening = FlapDampening(dampening_state_path,args.flap_half_life,args.flap_suppress,args.flap_reuse)
+        dampening.apply(instances)
+
+    # Look for other routers on the VRIDs of the instances, before keepalived starts sending its own advertisements
+    monitor = None
+    if args.vrrp_monitor:
+        local_addresses = set(address['addr'] for interface in interfaces
+                              for address in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []))
+        monitor = VrrpMonitor(instances,args.advert_int,local_addresses)
+        try:
+            monitor.open()
+        except socket.error as e:
+            raise ConfigError("Could not listen for VRRP advertisements (returned %s), is --net=host set" % e)
+        preflight.append(Preflight(monitor.listen,args.vrrp_listen))
+
+    # Work out how long failover can take with these timings, for the lowest priority instance as it takes over last
+    if check_script['enabled']:
+        node, check, failover = failover_times(args.advert_int,min(instance['priority'] for instance in instances),
+                                               args.check_interval,args.check_fall,check_script['timeout'],
+                                               check_script['daemon'],check_script['cache'])
+        errormsg = "Worst case failover with the %s profile: a failed node is detected in %.2fs," % (
+            args.failover_profile, node)
+        errormsg += " a failed check in %.2fs, and either is failed over in %.2fs" % (check, failover)
+    else:
+        node, check, failover = failover_times(args.advert_int,min(instance['priority'] for instance in instances))
+        errormsg = "Worst case failover with the %s profile: a failed node is detected and failed over in" % (
+            args.failover_profile)
+        errormsg += " %.2fs" % node
+    print errormsg
+
+    # Everything that relies on this script staying alive once keepalived is running
+    if args.exec_keepalived:
+        resident = [flag for flag, enabled in [('--supervise', args.supervise),
+                                               ('--watch', args.watch),
+                                               ('--metrics-port', args.metrics_port is not None),
+                                               ('--log-format json', args.log_format == 'json'),
+                                               ('--flap-dampening', args.flap_dampening),
+                                               ('--vrrp-monitor', args.vrrp_monitor),
+                                               ('notify hooks', bool(notify_hooks))] if enabled]
+        if resident:
+            raise ConfigError("--exec can not be used with %s" % ', '.join(resident))
+
+    # Setup the notify variables
+    notify = { 'enabled' : bool(notify_hooks),
+               'fifo'    : notify_fifo,
+             }
+
+    context = { # Subsitutions to be performed
+                'router_name'         : args.router_name,
+                'advert_int'          : args.advert_int,
+                'check_script'        : check_script,
+                'instances'           : instances,
+                'sync_groups'         : sync_groups,
+                'notify'              : notify,
+                'dampening'           : dampening,
+                'monitor'             : monitor,
+              }
+    return context, preflight, notify_hooks
 
-# Setup the check script variables
-check_script = { 'enabled'  : check_script_enabled,
-                 'path'     : scripts_path + args.override_check if args.override_check is not None else None,
-                 'interval' : args.check_interval, # int
-                 'rise'     : args.check_rise, # int
-                 'fall'     : args.check_fall, # int
-                 'url'      : urlparse.urlunparse(check_url_parsed) if check_url_parsed is not None else None,
-               }
-use_check_script = bool((args.enable_check is not None) or (args.override_check is not None))
 ########################################################################################################################
 # TEMPLATES                                                                                                            #
 # This is where you manage any templates                                                                               #
 ########################################################################################################################
-# Configuration Location goes here
-template_location = '/ka-templates'
-
-# Create the template list
-template_list = {}
-
-# Templates go here
-### 00-ls-input.conf ###
-template_name = 'keepalived.conf'
-template_dict = { 'context' : { # Subsitutions to be performed
-                                'router_name'         : args.router_name,
-                                'track_iface'         : args.track_iface,
-                                'is_master'           : args.master,
-                                'auth_pass'           : auth_pass,
-                                'virtual_router_id'   : int(vrid),
-                                'priority'            : int(args.priority),
-                                'check_script'        : check_script, 
-                                'virtual_ipaddresses' : vips,
-                                'virtual_routes'      : None, # This script currently doesn't handle routes yet
-                                                              # This is partially due to being complicated to
-                                                              # implement and the current lack of IPv6 support in
-                                                              # the version of keepalived this container has been
-                                                              # built to use
-                              },
-                  'path'    : '/etc/keepalived/keepalived.conf',
-                  'user'    : 'root',
-                  'group'   : 'root',
-                  'mode'    : 0644 }
-template_list[template_name] = template_dict
-
-# Load in the files from the folder
-template_loader = FileSystemLoader(template_location)
-template_env = TemplateEnvironment(loader=template_loader,
-                                   lstrip_blocks=True,
-                                   trim_blocks=True,
-                                   keep_trailing_newline=True)
-
-# Load in expected templates
-for template_item in template_list:
-    # Attempt to load the template
-    try:
-        template_list[template_item]['template'] = template_env.get_template(template_item)
-    except TemplateNotFound as e:
-        errormsg = "The template file %s was not found in %s (returned %s)," % (template_item, template_location, e)
-        errormsg += " terminating..."
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
+def render_templates(context,template_location='/ka-templates',fast_start=False,output_path=keepalived_conf_path,
+                     cache_path=template_cache_path):
+    """Render the templates in `template_location` with the substitutions in `context`, returning the template list.
+    With `fast_start` the compiled templates are cached in `cache_path`. Raises ConfigError if any of them could not
+    be written.
 
-    # Attempt to open the file for writing
-    try:
-        template_list[template_item]['file'] = open(template_list[template_item]['path'],'w')
-    except IOError as e:
-        errormsg = "The file %s could not be opened for writing for template" % template_list[template_item]['path']
-        errormsg += " %s (returned %s), terminating..." % template_item, e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restart
-    
-    # Stream
-    try:
-        template_list[template_item]['render'] = template_list[template_item]['template'].\
-                                             render(template_list[template_item]['context'])
-    
-        # Submit to file
-        template_list[template_item]['file'].write(template_list[template_item]['render'].encode('utf8'))
-        template_list[template_item]['file'].close()
-    except:
-        e = sys.exc_info()[0]
-        print "Unrecognised exception occured, was unable to create template (returned %s), terminating..." % e
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
+    keepalived.conf is written to `output_path` and owned by root, unless it is written somewhere else (as the
+    benchmarks do) in which case it is left owned by whoever rendered it."""
+    from jinja2 import Environment as TemplateEnvironment, \
+                       FileSystemLoader, FileSystemBytecodeCache, Template
+                            # Import the jinja2 libaries required by this script
+    from jinja2.exceptions import TemplateNotFound
+                            # Import any exceptions that are caught by the Templates section
 
+    # Create the template list
+    template_list = {}
 
-    # Change owner and group
-    try:
-        template_list[template_item]['uid'] = pwd.getpwnam(template_list[template_item]['user']).pw_uid
-    except KeyError as e:
-        errormsg = "The user %s does not exist for template %s" % template_list[template_item]['user'], template_item
-        errormsg += "(returned %s), terminating..." % e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
+    # Templates go here
+    ### 00-ls-input.conf ###
+    template_name = 'keepalived.conf'
+    template_dict = { 'context' : context,
+                      'path'    : output_path,
+                      'user'    : 'root' if output_path == keepalived_conf_path else None,
+                      'group'   : 'root' if output_path == keepalived_conf_path else None,
+                      'mode'    : 0644 }
+    template_list[template_name] = template_dict
 
-    try:
-        template_list[template_item]['gid'] = grp.getgrnam(template_list[template_item]['group']).gr_gid
-    except KeyError as e:
-        errormsg = "The group %s does not exist for template %s" % template_list[template_item]['group'], template_item
-        errormsg += "(returned %s), terminating..." % e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
+    # Keep the compiled templates between starts
+    template_cache = None
+    if fast_start:
+        try:
+            if not os.path.isdir(cache_path):
+                os.makedirs(cache_path)
+            template_cache = FileSystemBytecodeCache(cache_path)
+        except OSError as e:
+            print "WARNING: The template cache %s could not be created (returned %s)" % (cache_path, e)
 
-    try:
-        os.chown(template_list[template_item]['path'],
-                 template_list[template_item]['uid'],
-                 template_list[template_item]['gid'])
-    except OSError as e:
-        errormsg = "The file %s could not be chowned for template" % template_list[template_item]['path']
-        errormsg += " %s (returned %s), terminating..." % template_item, e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
+    # Load in the files from the folder
+    template_loader = FileSystemLoader(template_location)
+    template_env = TemplateEnvironment(loader=template_loader,
+                                       bytecode_cache=template_cache,
+                                       lstrip_blocks=True,
+                                       trim_blocks=True,
+                                       keep_trailing_newline=True)
 
-    # Change premisions
-    try:
-        os.chmod(template_list[template_item]['path'],
-                 template_list[template_item]['mode'])
-    except OSError as e:
-        errormsg = "The file %s could not be chmoded for template" % template_list[template_item]['path']
-        errormsg += " %s (returned %s), terminating..." % template_item, e
-        print errormsg
-        sys.exit(0) # This should be a return 0 to prevent the container from restarting
+    # Load in expected templates
+    for template_item in template_list:
+        # Attempt to load the template
+        try:
+            template_list[template_item]['template'] = template_env.get_template(template_item)
+        except TemplateNotFound as e:
+            raise ConfigError("The template file %s was not found in %s (returned %s)" % (template_item,
+                                                                                          template_location, e))
+
+        # Attempt to open the file for writing
+        try:
+            template_list[template_item]['file'] = open(template_list[template_item]['path'],'w')
+        except IOError as e:
+            errormsg = "The file %s could not be opened for writing" % template_list[template_item]['path']
+            errormsg += " for template %s (returned %s)" % (template_item, e)
+            raise ConfigError(errormsg)
+
+        # Stream
+        try:
+            # Write the template out as it is generated rather than building the whole render in memory first
+            template_list[template_item]['stream'] = template_list[template_item]['template'].\
+                                                 stream(template_list[template_item]['context'])
+            template_list[template_item]['stream'].enable_buffering(100) # Write in batches of 100 chunks
+
+            # Submit to file
+            template_list[template_item]['stream'].dump(template_list[template_item]['file'],'utf8')
+            template_list[template_item]['file'].close()
+        except:
+            e = sys.exc_info()[0]
+            raise ConfigError("Unrecognised exception occured, was unable to create template (returned %s)" % e)
+
+
+        # Change owner and group
+        if template_list[template_item]['user'] is not None:
+            try:
+                template_list[template_item]['uid'] = pwd.getpwnam(template_list[template_item]['user']).pw_uid
+            except KeyError as e:
+                errormsg = "The user %s does not exist for template %s" % (template_list[template_item]['user'],
+                                                                            template_item)
+                errormsg += " (returned %s)" % e
+                raise ConfigError(errormsg)
+
+            try:
+                template_list[template_item]['gid'] = grp.getgrnam(template_list[template_item]['group']).gr_gid
+            except KeyError as e:
+                errormsg = "The group %s does not exist for template %s" % (template_list[template_item]['group'],
+                                                                             template_item)
+                errormsg += " (returned %s)" % e
+                raise ConfigError(errormsg)
+
+            try:
+                os.chown(template_list[template_item]['path'],
+                         template_list[template_item]['uid'],
+                         template_list[template_item]['gid'])
+            except OSError as e:
+                errormsg = "The file %s could not be chowned for template" % template_list[template_item]['path']
+                errormsg += " %s (returned %s)" % (template_item, e)
+                raise ConfigError(errormsg)
+
+        # Change premisions
+        try:
+            os.chmod(template_list[template_item]['path'],
+                     template_list[template_item]['mode'])
+        except OSError as e:
+            errormsg = "The file %s could not be chmoded for template" % template_list[template_item]['path']
+            errormsg += " %s (returned %s)" % (template_item, e)
+            raise ConfigError(errormsg)
+
+    return template_list
 
 ########################################################################################################################
 # SPAWN CHILD                                                                                                          #
 ########################################################################################################################
-# Flush anything on the buffer
-sys.stdout.flush()
+def run_keepalived(args,context,notify_hooks,template_dict,startup_timing,phase_started):
+    """Start keepalived, and everything that runs alongside it, with the rendered `template_dict` and relay its
+    output until it exits, returning its return code. With --exec this does not return."""
+    instances = context['instances']
+    check_script = context['check_script']
+    notify = context['notify']
+    dampening = context['dampening']
+    monitor = context['monitor']
+
+    # Flush anything on the buffer
+    sys.stdout.flush()
 
+    # Serve the metrics, before anything is started so that every event is counted
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = Metrics()
+        metrics.dampening = dampening
+        metrics.monitor = monitor
+        if check_script['cache']:
+            metrics.probe_cache = probe_cache_path
+        for instance in instances:
+            metrics.add_instance(instance['name'])
+        try:
+            metrics_server = BaseHTTPServer.HTTPServer((args.metrics_address,args.metrics_port),MetricsHandler)
+        except socket.error as e:
+            raise ConfigError("The metrics could not be served on %s:%s (%s)" % (args.metrics_address,
+                                                                               args.metrics_port, e))
+        metrics_server.metrics = metrics
+        metrics_thread = Thread(target=metrics_server.serve_forever)
+        metrics_thread.daemon = True # Do not wait for this thread when exiting
+        metrics_thread.start()
+        if check_script['daemon']:
+            check_state_thread = Thread(target=watch_check_state,
+                                        args=(metrics,check_script['state_file'],check_script['interval']))
+            check_state_thread.daemon = True
+            check_state_thread.start()
+
+    # Start the notify dispatcher, keepalived writes each transition to its FIFO
+    if notify['enabled']:
+        try:
+            if os.path.exists(notify_fifo):
+                os.remove(notify_fifo) # Do not pick up a FIFO, or anything else, left over from a previous run
+            os.mkfifo(notify_fifo)
+        except OSError as e:
+            raise ConfigError("The notify FIFO %s could not be created (returned %s)" % (notify_fifo, e))
+        NotifyDispatcher(notify_fifo,notify_hooks,args.notify_workers,args.notify_timeout,metrics).start()
 
-# Spawn the child
-#child_path = ["cat","/etc/keepalived/keepalived.conf"]
-child_path = ["/usr/sbin/keepalived","--dont-fork","--log-console"]
-child = Popen(child_path, stdout = PIPE, stderr = STDOUT, shell = False)
+    # Start the check daemon first so a result is waiting for keepalived's first check
+    check_daemon = None
+    if check_script['daemon']:
+        check_daemon_path = ['/usr/local/bin/check_haproxy','--daemon',
+                             '--interval',str(check_script['interval']),
+                             '--state-file',check_script['state_file']] + check_script['argv']
+        if args.exec_keepalived:
+            # Nothing of this script is left to restart the daemon once keepalived has replaced it, so a shell does.
+            # It goes when the container does
+            loop = 'while true; do %s; echo "The check daemon exited (returned $?), restarting it"; sleep %s; done' % (
+                ' '.join(pipes.quote(arg) for arg in check_daemon_path), args.restart_backoff)
+            Popen(['/bin/sh','-c',loop], shell = False)
+        else:
+            # Restarted in place when it exits, its output is relayed alongside keepalived's
+            check_daemon_relay = LogRelay(None,args.log_format)
+            check_daemon = Supervisor(check_daemon_path,check_daemon_relay,None,args.restart_limit,
+                                      args.restart_window,args.restart_backoff,args.restart_backoff_max,
+                                      'The check daemon')
+            check_daemon.spawn()
+            atexit.register(cleanup, check_daemon, check_daemon_relay)
 
-# Register the atexit terminaton
-atexit.register(cleanup, child)
-signal(SIGTERM, lambda signum, stack_frame: exit(0)) # SIGTERM is not being caught correctly
-signal(SIGINT, lambda signum, stack_frame: exit(0))  # Also catch SIGINT (Keyboard Interupt)
+    # Spawn the child
+    #child_path = ["cat","/etc/keepalived/keepalived.conf"]
+    child_path = ["/usr/sbin/keepalived","--dont-fork","--log-console"]
 
-# Reopen stdout as unbuffered. This will mean log messages will appear as soon as they become avaliable.
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    # Or become it, keepalived keeps this process's PID, stdout and signals and its exit code is the container's
+    if args.exec_keepalived:
+        startup_timing.append(('exec', time.time() - phase_started))
+        if args.startup_timing:
+            print_startup_timing(startup_timing)
+        sys.stdout.flush()
+        try:
+            os.execv(child_path[0],child_path)
+        except OSError as e:
+            raise ConfigError("keepalived could not be run (returned %s)" % e)
+
+    log_relay = LogRelay(None,args.log_format,metrics,dampening)
+    child = Supervisor(child_path,log_relay,metrics,args.restart_limit if args.supervise else None,
+                       args.restart_window,args.restart_backoff,args.restart_backoff_max)
+    if dampening is not None:
+        # keepalived exiting may have suppressed an instance, so the configuration is rendered afresh for the restart
+        restart_stats = { 'reloads' : 0, 'skipped' : 0, 'failed' : 0 }
+        child.before_restart = lambda: reload_template(child,args,template_dict,restart_stats)
+    child.spawn()
+
+    # Report how long it took to get here
+    startup_timing.append(('spawn', time.time() - phase_started))
+    if args.startup_timing:
+        print_startup_timing(startup_timing)
+
+    # Register the atexit terminaton
+    atexit.register(cleanup, child, log_relay)
+    signal(SIGTERM, lambda signum, stack_frame: exit(0)) # SIGTERM is not being caught correctly
+    signal(SIGINT, lambda signum, stack_frame: exit(0))  # Also catch SIGINT (Keyboard Interupt)
+
+    # Keep the check daemon running
+    if check_daemon is not None:
+        check_daemon_thread = Thread(target=watch_check_daemon, args=(check_daemon,))
+        check_daemon_thread.daemon = True # Do not wait for this thread when exiting
+        check_daemon_thread.start()
+
+    # Keep track of the other routers
+    if monitor is not None:
+        monitor_thread = Thread(target=monitor.run)
+        monitor_thread.daemon = True # Do not wait for this thread when exiting
+        monitor_thread.start()
+
+    # Suppress and release flapping instances as it happens
+    if dampening is not None:
+        dampening_thread = Thread(target=watch_dampening, args=(child,args,template_dict,dampening))
+        dampening_thread.daemon = True # Do not wait for this thread when exiting
+        dampening_thread.start()
+
+    # Watch for changes to the configuration
+    if args.watch:
+        watch_thread = Thread(target=watch_config, args=(child,args,template_dict))
+        watch_thread.daemon = True # Do not wait for this thread when exiting
+        watch_thread.start()
+
+    # Reopen stdout as unbuffered. This will mean log messages will appear as soon as they become avaliable.
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+    # Output any log items to Docker, restarting keepalived if it exits and --supervise is given
+    return child.run()
+
+########################################################################################################################
+# MAIN                                                                                                                 #
+########################################################################################################################
+def main(argv=None):
+    """Configure and run keepalived with the command line arguments `argv`, or sys.argv if they are not given."""
+    # Register atexit
+    atexit.register(cleanup,None)
+
+    args = parse_arguments(argv)
+    startup_timing = [('imports and arguments', time.time() - startup_started)]
+    phase_started = time.time()
+
+    try:
+        context, preflight, notify_hooks = configure(args)
+        startup_timing.append(('validation', time.time() - phase_started))
+        phase_started = time.time()
+
+        # Run the preflight checks. With --fast-start they are left running while the templates are rendered
+        for check in preflight:
+            if args.fast_start:
+                check.start()
+            else:
+                check.run() # Run it in this thread and wait for it
+                if check.error is not None:
+                    raise ConfigError(check.error)
+        if not args.fast_start:
+            startup_timing.append(('preflight', time.time() - phase_started))
+            phase_started = time.time()
+
+        template_list = render_templates(context,fast_start=args.fast_start)
+        startup_timing.append(('templates', time.time() - phase_started))
+        phase_started = time.time()
+
+        # Wait for any preflight checks that were left running
+        if args.fast_start:
+            preflight_deadline = startup_started + args.preflight_timeout
+            for check in preflight:
+                check.join(max(0, preflight_deadline - time.time()))
+                if check.is_alive():
+                    print "The preflight checks did not finish in %s seconds, terminating..." % args.preflight_timeout
+                    sys.stdout.flush()
+                    os._exit(0) # Exit without waiting on the check that is still running. This should be a return 0
+                                # to prevent the container from restarting.
+                if check.error is not None:
+                    raise ConfigError(check.error)
+            startup_timing.append(('preflight (waiting after templates)', time.time() - phase_started))
+            phase_started = time.time()
+
+        returncode = run_keepalived(args,context,notify_hooks,template_list['keepalived.conf'],startup_timing,
+                                    phase_started)
+    except ConfigError as e:
+        print "%s, terminating..." % e
+        sys.exit(0) # This should be a return 0 to prevent the container from restarting.
 
-# Output any log items to Docker
-for line in iter(child.stdout.readline, ''):
-    sys.stdout.write(line)
+    # If the process terminates, read its errorcode and return it
+    sys.exit(returncode)
 
-# If the process terminates, read its errorcode and return it
-sys.exit(child.returncode)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
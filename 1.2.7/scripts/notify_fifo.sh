@@ -0,0 +1,10 @@
+#!/bin/sh
+# Pass a VRRP transition on to the notify dispatcher in entry without waiting for any hook to run. This is the notify
+# script keepalived runs when notify hooks are found in /ka-data/scripts/.
+#
+# usage: notify_fifo FIFO INSTANCE|GROUP NAME STATE
+#
+# The line is shorter than PIPE_BUF so the write is atomic, and as entry always holds the FIFO open, opening it never
+# blocks.
+[ -p "$1" ] || exit 0
+echo "$2 $3 $4" > "$1"
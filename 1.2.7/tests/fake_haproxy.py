@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# A stand-in for the HAProxy stats socket, so that check_haproxy --socket can be tested without HAProxy. It answers
+# `show info` and `show stat` over a UNIX socket, in interactive (prompt) mode as well as one command per connection.
+import os
+import socket
+import sys
+from threading import Thread, Lock
+
+stat_header = '# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,ereq,econ,eresp,wretr,wredis,status'
+
+class FakeHAProxy(object):
+    """Serves `servers`, a list of (backend, server, status) tuples, as `show stat` on the UNIX socket at `path`.
+
+    The servers can be changed while it is running. `connections` counts the connections accepted and `commands` the
+    commands answered, and drop() closes every open connection as HAProxy does when it is reloaded. While `hang` is
+    set commands are read but never answered, as by a HAProxy that has hung."""
+    def __init__(self,path,servers):
+        self.path = path
+        self.servers = list(servers)
+        self.lock = Lock()
+        self.connections = 0
+        self.commands = 0
+        self.hang = False
+        self.open = []
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+
+    def start(self):
+        thread = Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+        self.drop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def drop(self):
+        with self.lock:
+            connections, self.open = self.open, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            connection.close()
+
+    def serve(self):
+        while True:
+            try:
+                connection = self.sock.accept()[0]
+            except socket.error:
+                return # The socket was closed by stop()
+            with self.lock:
+                self.connections += 1
+                self.open.append(connection)
+            thread = Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def stat(self):
+        lines = [stat_header]
+        for backend in sorted(set(backend for backend, server, status in self.servers)):
+            lines.append('%s,FRONTEND,0,0,0,0,,0,0,0,,0,,0,0,0,0,OPEN' % backend)
+            for server_backend, server, status in self.servers:
+                if server_backend == backend:
+                    lines.append('%s,%s,0,0,0,0,,0,0,0,,0,,0,0,0,0,%s' % (backend, server, status))
+            lines.append('%s,BACKEND,0,0,0,0,,0,0,0,,0,,0,0,0,0,UP' % backend)
+        return '\n'.join(lines) + '\n\n'
+
+    def answer(self,command):
+        with self.lock:
+            self.commands += 1
+        if command == 'show info':
+            return 'Name: HAProxy\nVersion: 1.5.14\nNbproc: 1\n\n'
+        if command.startswith('show stat'):
+            return self.stat()
+        return 'Unknown command.\n\n'
+
+    def handle(self,connection):
+        prompt = False
+        buffered = ''
+        try:
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    return
+                buffered += data
+                while '\n' in buffered:
+                    command, buffered = buffered.split('\n',1)
+                    if self.hang:
+                        continue
+                    if command == 'prompt':
+                        prompt = True
+                        connection.sendall('\n> ')
+                        continue
+                    if not prompt: # Without prompt mode HAProxy answers one command and closes the connection
+                        connection.sendall(self.answer(command))
+                        return
+                    connection.sendall(self.answer(command) + '> ')
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+if __name__ == '__main__':
+    # Serve a couple of backends at the path given, for trying check_haproxy --socket by hand
+    fake = FakeHAProxy(sys.argv[1] if len(sys.argv) > 1 else '/tmp/haproxy.sock',
+                       [('web','s1','UP'), ('web','s2','DOWN'), ('web','s3','UP 1/3'), ('web','s4','MAINT'),
+                        ('api','a1','UP'), ('api','a2','no check')])
+    print "Serving the fake HAProxy stats socket on %s" % fake.path
+    fake.serve()
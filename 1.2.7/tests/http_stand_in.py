@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# A local HTTP server standing in for the URLs that check_haproxy checks, so that the checks can be tested without
+# HAProxy or a network.
+import BaseHTTPServer
+import SocketServer
+import time
+from threading import Thread
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers 200 OK with the body OK. /status/<code> answers with that status code instead, /body/<text> with that
+    body, and /slow hangs for longer than any check waits."""
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        status, body = 200, 'OK'
+        if self.path == '/slow':
+            time.sleep(5)
+        elif self.path.startswith('/status/'):
+            status = int(self.path[len('/status/'):])
+        elif self.path.startswith('/body/'):
+            body = self.path[len('/body/'):]
+        self.send_response(status)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class HTTPStandIn(object):
+    """Serves StandInHandler on a free port of 127.0.0.1 at `url`. `requests` lists the paths requested."""
+    def __init__(self):
+        self.server = StandInServer(('127.0.0.1',0),StandInHandler)
+        self.server.requests = self.requests = []
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
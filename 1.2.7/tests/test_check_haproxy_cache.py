@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Tests check_haproxy --cache, sharing probes of URLs and stats sockets between checks. Run with:
+# python -m unittest discover -s tests
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+from fake_haproxy import FakeHAProxy
+from http_stand_in import HTTPStandIn
+
+check_haproxy = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts','check_haproxy.py')
+
+class CheckHAProxyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory,'cache')
+        self.stand_in = HTTPStandIn().start()
+        self.url = self.stand_in.url
+        self.fakes = []
+
+    def tearDown(self):
+        self.stand_in.stop()
+        for fake in self.fakes:
+            fake.stop()
+        shutil.rmtree(self.directory)
+
+    def check(self,*args):
+        """Run a check through the cache, returning its return code and how long it took."""
+        started = time.time()
+        with open(os.devnull,'w') as devnull:
+            returncode = subprocess.call([sys.executable,check_haproxy,'--cache',self.cache,'--cache-ttl','10'] +
+                                         list(args),stdout=devnull)
+        return returncode, time.time() - started
+
+    def results(self):
+        """Return the values of the results in the cache."""
+        values = []
+        for name in os.listdir(self.cache):
+            if '.' not in name:
+                with open(os.path.join(self.cache,name)) as f:
+                    values.append(json.load(f)[1])
+        return values
+
+    def stats(self,target):
+        """Return the counts of the lookups of `target`, which is only probed one way in these tests."""
+        for name in os.listdir(self.cache):
+            if name.endswith('.stats'):
+                with open(os.path.join(self.cache,name)) as f:
+                    stats = json.load(f)
+                if target in stats:
+                    return stats[target]
+
+    def test_result_is_shared(self):
+        self.assertEqual(self.check(self.url + '/')[0],0)
+        self.assertEqual(self.check(self.url + '/')[0],0)
+        self.assertEqual(self.stand_in.requests,['/'])
+        self.assertEqual(self.results(),[True])
+        stats = self.stats(self.url + '/')
+        self.assertEqual((stats['hits'], stats['misses']),(1, 1))
+
+    def test_stats_of_a_target_probed_two_ways_are_added_up(self):
+        self.check(self.url + '/')
+        self.check(self.url + '/')
+        self.check('--status','200','--status','204',self.url + '/')
+        metrics = entry.Metrics()
+        metrics.probe_cache = self.cache
+        output = metrics.render()
+        self.assertIn('keepalived_probe_cache_hits_total{target="%s/"} 1' % self.url,output)
+        self.assertIn('keepalived_probe_cache_misses_total{target="%s/"} 2' % self.url,output)
+
+    def test_hung_target_is_cached_as_failed(self):
+        returncode, seconds = self.check('--timeout','0.5',self.url + '/slow')
+        self.assertEqual(returncode,1)
+        self.assertLess(seconds,2)
+        self.assertEqual(self.results(),[False])
+
+        # The next check uses the failure rather than waiting on the target again
+        returncode, seconds = self.check('--timeout','0.5',self.url + '/slow')
+        self.assertEqual(returncode,1)
+        self.assertLess(seconds,0.45)
+        self.assertEqual(self.stand_in.requests,['/slow'])
+        self.assertEqual(self.stats(self.url + '/slow')['hits'],1)
+
+    def fake(self,name,servers):
+        fake = FakeHAProxy(os.path.join(self.directory,name),servers).start()
+        self.fakes.append(fake)
+        return fake
+
+    def test_socket_is_keyed_by_the_socket_not_its_path(self):
+        fake = self.fake('haproxy.sock',[('web','s1','UP'), ('web','s2','DOWN')])
+        self.assertEqual(self.check('--socket',fake.path,'--min-capacity','50')[0],0)
+
+        # Another path to the same socket uses its result
+        os.link(fake.path,os.path.join(self.directory,'mounted.sock'))
+        self.assertEqual(self.check('--socket',os.path.join(self.directory,'mounted.sock'),'--min-capacity','50')[0],0)
+        self.assertEqual(fake.commands,1)
+
+        # A different HAProxy at the same path does not. The link keeps the old inode from being reused for it
+        fake.stop()
+        self.fakes.remove(fake)
+        replacement = self.fake('haproxy.sock',[('web','s1','DOWN'), ('web','s2','DOWN')])
+        self.assertEqual(self.check('--socket',replacement.path,'--min-capacity','50')[0],1)
+        self.assertEqual(replacement.commands,1)
+
+    def test_cache_that_can_not_be_used_probes_directly(self):
+        # A regular file where the directory should be, and a directory that can not be created below it
+        with open(self.cache,'w') as f:
+            f.write('not a directory')
+        fake = self.fake('haproxy.sock',[('web','s1','UP'), ('web','s2','DOWN')])
+        self.assertEqual(self.check('--socket',fake.path,'--min-capacity','50')[0],0)
+        self.assertEqual(fake.commands,1)
+        self.assertEqual(self.check(self.url + '/')[0],0)
+
+        self.cache = os.path.join(self.cache,'cache')
+        self.assertEqual(self.check(self.url + '/')[0],0)
+        self.assertEqual(self.check(self.url + '/status/503')[0],1)
+        self.assertEqual(self.stand_in.requests,['/', '/', '/status/503'])
+
+if __name__ == '__main__':
+    unittest.main()
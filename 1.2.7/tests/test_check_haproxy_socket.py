@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Tests check_haproxy --socket against the fake HAProxy stats socket. Run with: python -m unittest discover -s tests
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import check_haproxy
+from fake_haproxy import FakeHAProxy
+
+check_haproxy_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts','check_haproxy.py')
+
+class CheckHAProxySocketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory,'check.state')
+        self.fake = FakeHAProxy(os.path.join(self.directory,'haproxy.sock'),
+                                [('web','s1','UP'), ('web','s2','DOWN'), ('web','s3','UP 1/3'), ('web','s4','MAINT'),
+                                 ('api','a1','UP'), ('api','a2','no check')]).start()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.directory)
+
+    def check(self,*args):
+        return subprocess.call([sys.executable,check_haproxy_path,'--socket',self.fake.path,'--timeout','1'] +
+                               list(args))
+
+    def read_state(self,timeout=5):
+        """Wait for the daemon to publish a result, returning its return code and capacity."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with open(self.state_file) as f:
+                    fields = f.read().split()
+                return int(fields[0]), int(fields[3])
+            except (IOError, IndexError):
+                time.sleep(0.05)
+        self.fail('The daemon did not publish a result')
+
+    def test_min_capacity(self):
+        # web has 2 of 4 servers up (UP 1/3 is still up), api has 2 of 2 (no check counts as up)
+        self.assertEqual(self.check('--min-capacity','50'),0)
+        self.assertEqual(self.check('--min-capacity','51'),1)
+        self.assertEqual(self.check('--backend','api','--min-capacity','100'),0)
+
+    def test_missing_backend_has_no_capacity(self):
+        self.assertEqual(self.check('--backend','db'),1)
+
+    def test_missing_socket_fails(self):
+        self.fake.stop()
+        self.assertEqual(self.check(),1)
+
+    def test_hung_socket_fails_by_the_deadline(self):
+        # Neither the connection nor a reconnection may take the check past its --timeout
+        self.fake.hang = True
+        stats_socket = check_haproxy.StatsSocket(self.fake.path,0.5)
+        for _ in range(2):
+            started = time.time()
+            self.assertEqual(check_haproxy.check_socket(stats_socket,None,1),(1, 0))
+            self.assertLess(time.time() - started,0.7)
+
+        # Nor may HAProxy hanging on a connection that was already open
+        self.fake.hang = False
+        self.assertEqual(check_haproxy.check_socket(stats_socket,['web'],50),(0, 50))
+        self.fake.hang = True
+        started = time.time()
+        self.assertEqual(check_haproxy.check_socket(stats_socket,['web'],50),(1, 0))
+        self.assertLess(time.time() - started,0.7)
+        self.assertEqual(self.fake.connections,3)
+
+    def test_daemon_keeps_one_connection(self):
+        daemon = subprocess.Popen([sys.executable,check_haproxy_path,'--socket',self.fake.path,'--daemon',
+                                   '--interval','0.1','--state-file',self.state_file,'--backend','web'])
+        try:
+            self.assertEqual(self.read_state(),(0, 50))
+            time.sleep(0.5)
+            self.assertGreater(self.fake.commands,3)
+            self.assertEqual(self.fake.connections,1)
+
+            # A reload of HAProxy drops the connection, the daemon reconnects and sees the new capacity
+            self.fake.servers = [('web','s1','UP'), ('web','s2','UP'), ('web','s3','DOWN'), ('web','s4','UP')]
+            self.fake.drop()
+            deadline = time.time() + 5
+            while self.read_state()[1] != 75 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(self.read_state(),(0, 75))
+            self.assertEqual(self.fake.connections,2)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+if __name__ == '__main__':
+    unittest.main()
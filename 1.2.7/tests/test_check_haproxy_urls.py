@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Tests check_haproxy's check of URLs: the quorum, the deadline, the accepted statuses and the body match. Run with:
+# python -m unittest discover -s tests
+import os
+import re
+import sys
+import time
+import unittest
+import requests
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import check_haproxy
+from http_stand_in import HTTPStandIn
+
+class CheckURLsTest(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = HTTPStandIn().start()
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def check(self,paths,quorum=None,timeout=1,statuses=None,match=None):
+        """Check the stand-in's `paths`, returning the return code and how long the check took."""
+        sessions = dict((self.stand_in.url + path, requests.Session()) for path in paths)
+        started = time.time()
+        returncode = check_haproxy.check(sessions,timeout,len(paths) if quorum is None else quorum,
+                                         set(statuses or [200]),re.compile(match) if match is not None else None)
+        return returncode, time.time() - started
+
+    def test_quorum(self):
+        paths = ['/', '/status/500', '/status/503']
+        self.assertEqual(self.check(paths,quorum=1)[0],0)
+        self.assertEqual(self.check(paths,quorum=2)[0],1)
+        self.assertEqual(self.check(paths)[0],1) # all
+        self.assertEqual(self.check(['/', '/body/up', '/status/503'],quorum=2)[0],0)
+        self.assertEqual(self.check(['/', '/body/up'])[0],0)
+
+    def test_hung_url_ends_the_check_at_the_deadline(self):
+        returncode, seconds = self.check(['/', '/slow'],timeout=0.5)
+        self.assertEqual(returncode,1)
+        self.assertGreaterEqual(seconds,0.5)
+        self.assertLess(seconds,1)
+
+    def test_check_returns_once_the_outcome_is_known(self):
+        # Once the quorum has passed, or can no longer pass, there is no waiting on the hung URL
+        self.assertLess(self.check(['/', '/slow'],quorum=1,timeout=2)[1],1)
+        returncode, seconds = self.check(['/status/500', '/status/503', '/slow'],quorum=2,timeout=2)
+        self.assertEqual(returncode,1)
+        self.assertLess(seconds,1)
+
+    def test_status(self):
+        self.assertEqual(self.check(['/status/204'])[0],1)
+        self.assertEqual(self.check(['/status/204'],statuses=[200, 204])[0],0)
+        self.assertEqual(self.check(['/'],statuses=[204])[0],1)
+
+    def test_match(self):
+        self.assertEqual(self.check(['/body/healthy'],match='health')[0],0)
+        self.assertEqual(self.check(['/body/unhealthy'],match='^health')[0],1)
+        self.assertEqual(self.check(['/status/503'],statuses=[503],match='OK')[0],0)
+        self.assertEqual(self.check(['/status/503'],statuses=[503],match='up')[0],1)
+
+    def test_unreachable_url_fails(self):
+        sessions = { 'http://127.0.0.1:1/' : requests.Session() }
+        self.assertEqual(check_haproxy.check(sessions,1,1,set([200]),None),1)
+
+if __name__ == '__main__':
+    unittest.main()
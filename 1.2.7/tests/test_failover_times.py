@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Tests the worst case failover times printed on startup against a simulated timeline of adverts and checks. Run with:
+# python -m unittest discover -s tests
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+
+runs = 20000
+
+def node_failure(rng,advert_int,priority):
+    """Simulate a master failing at a random time, returning the seconds until a backup with `priority` notices."""
+    phase = rng.uniform(0,advert_int) # When the master sends its adverts
+    failed = rng.uniform(10,20)
+    last_advert = phase + (failed - phase) // advert_int * advert_int
+    master_down = 3 * advert_int + (256 - priority) * advert_int / 256.0 # Reset by every advert the backup receives
+    return last_advert + master_down - failed
+
+def check_failure(rng,check_interval,check_fall,check_timeout,check_daemon=False,check_cache=False):
+    """Simulate the target of the check failing at a random time, returning the seconds until keepalived sees
+    `check_fall` failed checks in a row. A failed check takes the whole `check_timeout`, as a hung target would."""
+    failed = rng.uniform(10,20)
+    # With the cache a check uses a result of another's probe started up to a check interval before it, which may
+    # have been started just before the failure
+    stale_until = failed + (rng.uniform(0,check_interval) if check_cache else 0)
+
+    def check_starts(phase):
+        """The start of every check after the failure that gets a result from the target after it failed."""
+        start = phase + (stale_until - phase) // check_interval * check_interval
+        if start < stale_until:
+            start += check_interval
+        while True:
+            yield start
+            start += check_interval
+
+    starts = check_starts(rng.uniform(0,check_interval))
+    if not check_daemon:
+        # keepalived runs the check itself, the fall-th failed check in a row fails the instance as it finishes
+        for _ in range(check_fall):
+            start = next(starts)
+        return start + check_timeout - failed
+
+    # The daemon publishes the first failed result once its check times out, and keepalived reads it with check_state
+    # on its own schedule, which is instant
+    published = next(starts) + check_timeout
+    read_phase = rng.uniform(0,check_interval)
+    read = read_phase + (published - read_phase) // check_interval * check_interval
+    if read < published:
+        read += check_interval
+    return read + (check_fall - 1) * check_interval - failed
+
+def failover_after_check(rng,check,advert_int):
+    """Once the check has failed the master sends its lower priority on its next advert, and a backup takes over."""
+    return check + rng.uniform(0,advert_int)
+
+class FailoverTimesTest(unittest.TestCase):
+    cases = [ # advert_int, priority, check_interval, check_fall, check_timeout, check_daemon, check_cache
+        (1, 100, 2, 2, 2.0, False, False),  # --failover-profile standard
+        (1, 100, 1, 1, 0.5, False, False),  # --failover-profile fast
+        (1, 150, 1, 1, 0.5, True, False),   # fast with --check-daemon
+        (1, 100, 2, 2, 2.0, False, True),   # standard with --check-cache
+        (2, 1, 3, 3, 1.5, True, True),      # --check-daemon and --check-cache with the lowest priority
+    ]
+
+    def assertBound(self,simulated,bound,case):
+        # The simulated worst case must never be over the bound, and should come close to it
+        self.assertLessEqual(max(simulated),bound + 1e-9,case)
+        self.assertGreater(max(simulated),bound * 0.97,case)
+
+    def test_bounds_hold_against_simulation(self):
+        rng = random.Random(1)
+        for case in self.cases:
+            advert_int, priority, check_interval, check_fall, check_timeout, check_daemon, check_cache = case
+            node, check, failover = entry.failover_times(advert_int,priority,check_interval,check_fall,check_timeout,
+                                                         check_daemon,check_cache)
+            nodes = [node_failure(rng,advert_int,priority) for _ in range(runs)]
+            checks = [check_failure(rng,check_interval,check_fall,check_timeout,check_daemon,check_cache)
+                      for _ in range(runs)]
+            failovers = [failover_after_check(rng,simulated,advert_int) for simulated in checks]
+            self.assertBound(nodes,node,case)
+            self.assertBound(checks,check,case)
+            self.assertBound(nodes + failovers,failover,case)
+
+    def test_without_a_check(self):
+        node, check, failover = entry.failover_times(1,100)
+        self.assertEqual(check,None)
+        self.assertEqual(node,failover)
+        self.assertAlmostEqual(node,3 + 156 / 256.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# Tests --flap-dampening by replaying keepalived's output through the log relay with a fake clock. Run with:
+# python -m unittest discover -s tests
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from threading import Thread
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+
+half_life, suppress, reuse = 900, 2000, 750
+templates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','templates')
+
+class FakeChild(object):
+    """Stands in for the Supervisor of keepalived, counting the SIGHUPs it is sent."""
+    def __init__(self):
+        self.signals = []
+    def send_signal(self,signum):
+        self.signals.append(signum)
+        return True
+
+class FlapDampeningTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'vrrp-state.json')
+        self.now = 1000000.0
+        self.time = entry.time.time
+        entry.time.time = lambda: self.now
+
+        # Send anything written to stdout, by the relay or as a warning, to a file instead
+        sys.stdout.flush()
+        self.stdout = os.dup(1)
+        output = os.open(os.path.join(self.directory,'output'),os.O_WRONLY | os.O_CREAT)
+        os.dup2(output,1)
+        os.close(output)
+
+    def tearDown(self):
+        entry.time.time = self.time
+        sys.stdout.flush()
+        os.dup2(self.stdout,1)
+        os.close(self.stdout)
+        shutil.rmtree(self.directory)
+
+    def output(self):
+        sys.stdout.flush()
+        with open(os.path.join(self.directory,'output')) as f:
+            return f.read()
+
+    def dampening(self):
+        return entry.FlapDampening(self.path,half_life,suppress,reuse)
+
+    def replay(self,dampening,log):
+        """Relay each chunk of `log`, a list of the seconds since the last chunk and the chunk, through a LogRelay."""
+        source, sink = os.pipe()
+        try:
+            log_relay = entry.LogRelay(source,'plain',None,dampening)
+            for seconds, chunk in log:
+                self.now += seconds
+                os.write(sink,chunk)
+                log_relay.relay_chunk()
+            os.close(sink)
+            sink = None
+            log_relay.relay()
+        finally:
+            os.close(source)
+            if sink is not None:
+                os.close(sink)
+
+    def apply(self,dampening,name='web'):
+        instance = { 'name' : name, 'is_master' : True, 'nopreempt' : False, 'preempt_delay' : None }
+        dampening.apply([instance])
+        return instance
+
+    def flaps(self,count,seconds=10,name='web'):
+        """A log of `name` starting as a backup and then changing state `count` times, `seconds` apart."""
+        states = ['BACKUP','MASTER']
+        return [(seconds, 'Keepalived_vrrp: VRRP_Instance(%s) Entering %s STATE\n' % (name, states[flap % 2]))
+                for flap in range(count + 1)]
+
+    def test_stable_instance_is_left_alone(self):
+        dampening = self.dampening()
+        self.replay(dampening,self.flaps(0) + [(10, 'Keepalived_vrrp: VRRP_Instance(web) Entering BACKUP STATE\n')])
+        self.assertEqual(self.apply(dampening),{ 'name' : 'web', 'is_master' : True, 'nopreempt' : False,
+                                                 'preempt_delay' : None })
+        self.assertEqual(dampening.status()['web'],(0.0, False, 1))
+
+    def test_flapping_instance_is_suppressed_until_it_decays(self):
+        dampening = self.dampening()
+        self.replay(dampening,self.flaps(3))
+        penalty, suppressed, transitions = dampening.status()['web']
+        self.assertTrue(suppressed)
+        self.assertEqual(transitions,4)
+        self.assertAlmostEqual(penalty,1000 * (0.5 ** (20.0 / half_life) + 0.5 ** (10.0 / half_life) + 1))
+        self.assertIn('has changed state 4 times recently',self.output())
+
+        # The penalty is remembered across a restart, still above reuse after one half life. It was the master when
+        # keepalived stopped, so the restart is a flap too
+        self.now += half_life
+        dampening = self.dampening()
+        self.assertAlmostEqual(dampening.status()['web'][0],penalty / 2 + 1000)
+        instance = self.apply(dampening)
+        self.assertEqual((instance['is_master'], instance['nopreempt']),(False, True))
+
+        # Once it decays below reuse it is released, and takes over again as it did before
+        self.now += 2 * half_life
+        dampening = self.dampening()
+        self.assertEqual(self.apply(dampening),{ 'name' : 'web', 'is_master' : True, 'nopreempt' : False,
+                                                 'preempt_delay' : None })
+        self.assertFalse(dampening.status()['web'][1])
+        self.assertIn('is stable again',self.output())
+
+    def test_penalty_above_reuse_delays_preemption(self):
+        dampening = self.dampening()
+        self.replay(dampening,self.flaps(1))
+        instance = self.apply(dampening)
+        self.assertEqual((instance['is_master'], instance['nopreempt']),(False, False))
+        # The delay is how long the penalty of 1000 takes to decay below reuse
+        self.assertEqual(instance['preempt_delay'],374)
+
+    def test_restart_while_master_is_a_flap(self):
+        # keepalived starts an instance configured as the master straight in MASTER, so only the stop shows the flap
+        master = [(10, 'Keepalived_vrrp: VRRP_Instance(web) Entering MASTER STATE\n')]
+        dampening = self.dampening()
+        self.replay(dampening,master)
+        self.assertEqual(dampening.status()['web'],(0.0, False, 1))
+        for restart in range(2):
+            dampening = self.dampening()
+            self.replay(dampening,master)
+        penalty, suppressed, transitions = dampening.status()['web']
+        self.assertAlmostEqual(penalty,1000 * (0.5 ** (20.0 / half_life) + 0.5 ** (10.0 / half_life)))
+        self.assertEqual((suppressed, transitions),(False, 5))
+        self.assertEqual([state for _, state in dampening.records['web']['transitions']],
+                         ['MASTER', 'STOPPED', 'MASTER', 'STOPPED', 'MASTER'])
+
+        # The third restart in a row suppresses it
+        instance = self.apply(self.dampening())
+        self.assertEqual((instance['is_master'], instance['nopreempt']),(False, True))
+
+    def test_restart_while_backup_is_not_a_flap(self):
+        backup = [(10, 'Keepalived_vrrp: VRRP_Instance(web) Entering BACKUP STATE\n')]
+        for restart in range(3):
+            dampening = self.dampening()
+            self.replay(dampening,backup)
+        self.assertEqual(dampening.status()['web'],(0.0, False, 5))
+
+    def test_state_change_split_between_chunks(self):
+        dampening = self.dampening()
+        self.replay(dampening,self.flaps(0) + [(10, 'Keepalived_vrrp: VRRP_Instance(web) Ent'),
+                                               (0, 'ering MASTER STATE\nKeepalived_vrrp: VRRP_Instance(web) Entering')])
+        self.assertEqual(dampening.status()['web'][2],2)
+        self.assertEqual(dampening.records['web']['state'],'MASTER')
+
+    def test_invalid_records_are_discarded(self):
+        valid = { 'state' : 'MASTER', 'penalty' : 3000.0, 'updated' : self.now, 'suppressed' : True,
+                  'transitions' : [[self.now, 'MASTER']] }
+        records = { 'web' : valid, 'not_a_dict' : [], 'missing' : { 'state' : 'MASTER' } }
+        for key, value in (('penalty', True), ('penalty', -1), ('updated', '1000000'), ('suppressed', 1),
+                           ('state', 5), ('transitions', {}), ('transitions', [[self.now]]),
+                           ('transitions', [['1000000', 'MASTER']])):
+            record = dict(valid)
+            record[key] = value
+            records['%s_%r' % (key, value)] = record
+        with open(self.path,'w') as f:
+            json.dump(records,f)
+
+        dampening = self.dampening()
+        self.assertEqual(dampening.records.keys(),['web'])
+        self.assertEqual(self.output().count('discarding it'),len(records) - 1)
+        for name in records:
+            self.apply(dampening,name)
+        self.replay(dampening,self.flaps(1,name='missing'))
+        self.assertEqual(dampening.status()['missing'][2],2)
+
+    def test_unreadable_file_starts_afresh(self):
+        for content in ('{"web": ', '[]'):
+            with open(self.path,'w') as f:
+                f.write(content)
+            self.assertEqual(self.dampening().records,{})
+
+    # Suppressing and releasing instances while keepalived runs, rather than only when it is next started
+    def test_suppression_wakes_the_reload(self):
+        dampening = self.dampening()
+        waiting = Thread(target=dampening.wait_for_change)
+        waiting.daemon = True
+        waiting.start()
+        self.replay(dampening,self.flaps(2))
+        waiting.join(0.2)
+        self.assertTrue(waiting.is_alive()) # A state change that does not suppress it needs no reload
+        self.replay(dampening,self.flaps(1))
+        waiting.join(2)
+        self.assertFalse(waiting.is_alive())
+
+    def test_release_is_scheduled_for_the_decay_below_reuse(self):
+        dampening = self.dampening()
+        self.replay(dampening,self.flaps(3))
+        self.apply(dampening)
+        self.assertEqual(dampening.restrained,set(['web']))
+        released = dampening.decayed(dampening.records['web'])
+        self.assertAlmostEqual(dampening.penalty(dampening.records['web'],released - 1),reuse)
+
+        waiting = Thread(target=dampening.wait_for_change)
+        waiting.daemon = True
+        waiting.start()
+        waiting.join(0.2)
+        self.assertTrue(waiting.is_alive())
+        self.now = released
+        with dampening.lock:
+            dampening.condition.notify() # Wake it as the timeout would
+        waiting.join(2)
+        self.assertFalse(waiting.is_alive())
+        self.assertEqual(self.apply(dampening),{ 'name' : 'web', 'is_master' : True, 'nopreempt' : False,
+                                                 'preempt_delay' : None })
+
+    def test_keepalived_is_reloaded_with_the_suppression_and_the_release(self):
+        config_path = os.path.join(self.directory,'keepalived.json')
+        with open(config_path,'w') as f:
+            json.dump({ 'instances' : [{ 'name' : 'web', 'interface' : 'lo', 'vrid' : 51, 'priority' : 100,
+                                         'master' : True, 'auth_pass' : 'secret', 'include' : ['10.1.0.1/32/lo'] }] },f)
+        state_path, entry.dampening_state_path = entry.dampening_state_path, self.path
+        try:
+            args = entry.parse_arguments(['--config',config_path,'--flap-dampening'])
+            context = entry.configure(args)[0]
+        finally:
+            entry.dampening_state_path = state_path
+        output_path = os.path.join(self.directory,'keepalived.conf')
+        template_dict = entry.render_templates(context,templates_path,output_path=output_path)['keepalived.conf']
+        dampening, child, stats = context['dampening'], FakeChild(), { 'reloads' : 0, 'skipped' : 0, 'failed' : 0 }
+        def reload_once():
+            # As watch_dampening() does
+            dampening.wait_for_change()
+            entry.reload_template(child,args,template_dict,stats)
+            with open(output_path) as f:
+                return f.read()
+
+        self.replay(dampening,self.flaps(3))
+        config = reload_once()
+        self.assertIn('state BACKUP',config)
+        self.assertIn('nopreempt',config)
+
+        self.now = dampening.decayed(dampening.records['web'])
+        config = reload_once()
+        self.assertIn('state MASTER',config)
+        self.assertNotIn('nopreempt',config)
+        self.assertEqual(child.signals,[entry.SIGHUP] * 2)
+        self.assertEqual(stats,{ 'reloads' : 2, 'skipped' : 0, 'failed' : 0 })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Tests the validation of the instances in a --config file. Run with: python -m unittest discover -s tests
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+
+interfaces = set(['lo','eth0'])
+
+def instance(**overrides):
+    item = { 'name' : 'web', 'interface' : 'eth0', 'vrid' : 51, 'priority' : 100, 'include' : ['10.1.0.1/24/eth0'] }
+    item.update(overrides)
+    return item
+
+class InstanceCheckTest(unittest.TestCase):
+    def test_valid_instance(self):
+        instances = []
+        entry.instance_check(instances,instance(),interfaces)
+        self.assertEqual(instances[0]['virtual_router_id'],51)
+        self.assertEqual(instances[0]['priority'],100)
+        self.assertEqual([vip['addr'] for vip in instances[0]['virtual_ipaddresses']],['10.1.0.1'])
+
+    def test_vrid_and_priority_must_be_integers(self):
+        # YAML reads true and false as booleans, which are also ints in Python
+        for key in ('vrid','priority'):
+            for value in (True, False, '51', 51.0, None):
+                self.assertRaises(entry.ConfigError,entry.instance_check,[],instance(**{ key : value }),interfaces)
+
+    def test_vrid_and_priority_ranges(self):
+        for key in ('vrid','priority'):
+            for value in (0, 256):
+                self.assertRaises(entry.ConfigError,entry.instance_check,[],instance(**{ key : value }),interfaces)
+            entry.instance_check([],instance(**{ key : 255 }),interfaces)
+
+    def test_unknown_interface(self):
+        self.assertRaises(entry.ConfigError,entry.instance_check,[],instance(interface='eth9'),interfaces)
+        self.assertRaises(entry.ConfigError,entry.instance_check,[],instance(include=['10.1.0.1/24/eth9']),interfaces)
+
+class LoadInstancesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'keepalived.json')
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def load(self,instances,sync_groups=None):
+        with open(self.path,'w') as f:
+            json.dump({ 'instances' : instances, 'sync_groups' : sync_groups or [] },f)
+        return entry.load_instances(entry.parse_arguments(['--config',self.path]),interfaces)
+
+    def test_sync_group_names(self):
+        group = { 'name' : 'front', 'instances' : ['web'] }
+        self.assertEqual(self.load([instance()],[group])[1],[{ 'name' : 'front', 'instances' : ['web'] }])
+        for name in ('front end', 'front}', 'front\n}\nvrrp_instance x {', ''):
+            self.assertRaises(entry.ConfigError,self.load,[instance()],[dict(group, name=name)])
+
+    def test_sync_group_members_are_compared_as_strings(self):
+        # YAML reads an instance named 5 as a number, in the instance and in the sync group alike
+        instances, sync_groups = self.load([instance(name=5)],[{ 'instances' : [5] }])
+        self.assertEqual(sync_groups,[{ 'name' : 'group_1', 'instances' : ['5'] }])
+        self.assertRaises(entry.ConfigError,self.load,[instance()],[{ 'instances' : ['db'] }])
+
+    def test_auth_pass(self):
+        self.assertEqual(self.load([instance(auth_pass='s3cret')])[0][0]['auth_pass'],'s3cret')
+        for auth_pass in (12345678, True, ['secret'], 'two words', 'secret}', 'se"cret', 'secret#', ''):
+            self.assertRaises(entry.ConfigError,self.load,[instance(auth_pass=auth_pass)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Tests the log relay's formatting of keepalived's output as JSON. Run with: python -m unittest discover -s tests
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+
+class LogRelayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # Send anything the relay writes to stdout to a file instead
+        sys.stdout.flush()
+        self.stdout = os.dup(1)
+        output = os.open(os.path.join(self.directory,'output'),os.O_WRONLY | os.O_CREAT)
+        os.dup2(output,1)
+        os.close(output)
+
+    def tearDown(self):
+        sys.stdout.flush()
+        os.dup2(self.stdout,1)
+        os.close(self.stdout)
+        shutil.rmtree(self.directory)
+
+    def relay(self,output):
+        """Relay `output` from keepalived as JSON, returning the objects written."""
+        source, sink = os.pipe()
+        os.write(sink,output)
+        os.close(sink)
+        try:
+            entry.LogRelay(source,'json').relay()
+        finally:
+            os.close(source)
+        with open(os.path.join(self.directory,'output')) as f:
+            return [json.loads(line) for line in f]
+
+    def test_events(self):
+        lines = self.relay('Keepalived_vrrp: VRRP_Instance(web) Entering MASTER STATE\nKeepalived: Starting\n')
+        self.assertEqual([(line['event'], line['message']) for line in lines],[
+            ('state', 'Keepalived_vrrp: VRRP_Instance(web) Entering MASTER STATE'),
+            ('log', 'Keepalived: Starting'),
+        ])
+        self.assertEqual((lines[0]['instance'], lines[0]['state']),('web', 'MASTER'))
+
+    def test_bytes_that_are_not_utf8(self):
+        # An interface or instance name in Latin-1 is relayed with a replacement character rather than ending the relay
+        lines = self.relay('Keepalived_vrrp: iface \xe9th0 up\nKeepalived_vrrp: VRRP_Instance(w\xe9b) Entering BACKUP '
+                           'STATE\nKeepalived_vrrp: caf\xc3\xa9\n')
+        self.assertEqual([line['message'] for line in lines],[
+            u'Keepalived_vrrp: iface \ufffdth0 up',
+            u'Keepalived_vrrp: VRRP_Instance(w\ufffdb) Entering BACKUP STATE',
+            u'Keepalived_vrrp: caf\xe9',
+        ])
+        self.assertEqual(lines[1]['instance'],u'w\ufffdb')
+
+    def test_partial_last_line(self):
+        self.assertEqual([line['message'] for line in self.relay('Keepalived: one\nKeepalived: tw\xe9')],
+                         ['Keepalived: one', u'Keepalived: tw\ufffd'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Tests the restarts of keepalived by --supervise with a command that exits straight away and a fake clock. Run with:
+# python -m unittest discover -s tests
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000000.0
+        self.uptime = 0     # The seconds keepalived runs for on the fake clock before it exits
+        self.sleeps = []    # The range of each delay before a restart, which is always taken at its longest
+        self.restarts = None # Once this many delays have been slept, keepalived is stopped rather than restarted
+        self.time, self.sleep, self.uniform = entry.time.time, entry.time.sleep, entry.random.uniform
+        entry.time.time = lambda: self.now
+        entry.time.sleep = self.fake_sleep
+        entry.random.uniform = lambda low, high: (self.sleeps.append((low, high)), high)[1]
+
+        # Send anything written to stdout, by keepalived or as a message, to a file instead
+        sys.stdout.flush()
+        self.stdout = os.dup(1)
+        output = os.open(os.path.join(self.directory,'output'),os.O_WRONLY | os.O_CREAT)
+        os.dup2(output,1)
+        os.close(output)
+
+    def tearDown(self):
+        entry.time.time, entry.time.sleep, entry.random.uniform = self.time, self.sleep, self.uniform
+        sys.stdout.flush()
+        os.dup2(self.stdout,1)
+        os.close(self.stdout)
+        shutil.rmtree(self.directory)
+
+    def fake_sleep(self,seconds):
+        self.now += seconds
+        if len(self.sleeps) == self.restarts:
+            self.supervisor.terminate()
+
+    def output(self):
+        sys.stdout.flush()
+        with open(os.path.join(self.directory,'output')) as f:
+            return f.read()
+
+    def supervise(self,metrics=None,dampening=None,**kwargs):
+        """Supervise a keepalived that enters MASTER and exits with 3 as soon as it has started, returning the
+        seconds it took to recover from each exit as reported to `metrics`."""
+        recovered = []
+        if metrics is not None:
+            observe_restart = metrics.observe_restart
+            metrics.observe_restart = lambda seconds: (recovered.append(seconds), observe_restart(seconds))
+        log_relay = entry.LogRelay(None,'plain',None,dampening)
+        relay = log_relay.relay
+        def relay_until_exit():
+            relay()
+            self.now += self.uptime
+        log_relay.relay = relay_until_exit
+
+        command = [sys.executable,'-c','import sys; print "Starting keepalived"; '
+                   'print "Keepalived_vrrp: VRRP_Instance(web) Entering MASTER STATE"; sys.exit(3)']
+        self.supervisor = entry.Supervisor(command,log_relay,metrics,**kwargs)
+        self.supervisor.spawn()
+        self.returncode = self.supervisor.run()
+        return recovered
+
+    def test_crash_loop_backs_off_and_is_left_to_the_container(self):
+        metrics = entry.Metrics()
+        recovered = self.supervise(metrics,restart_limit=5,restart_window=60,backoff=1,max_backoff=4)
+        self.assertEqual(self.returncode,3)
+
+        # The delay doubles with every exit in the window until it reaches the cap
+        self.assertEqual(self.sleeps,[(0.5, 1), (1, 2), (2, 4), (2, 4), (2, 4)])
+        self.assertEqual(recovered,[1, 2, 4, 4, 4])
+        self.assertEqual((metrics.child_restarts, metrics.child_recover),(5, 4))
+
+        # The sixth exit within the window is one more than restart_limit
+        output = self.output()
+        self.assertEqual(output.count('Starting keepalived'),6)
+        self.assertIn('keepalived exited 6 times in 60 seconds (returned 3), terminating...',output)
+        self.assertIn('keepalived exited (returned 3), restarting it in 4.0 seconds',output)
+
+    def test_exits_outside_the_window_do_not_add_up(self):
+        # keepalived runs for a minute each time, so only its last exit is ever within the window
+        self.uptime = 60
+        self.restarts = 8
+        recovered = self.supervise(entry.Metrics(),restart_limit=2,restart_window=30,backoff=1,max_backoff=4)
+        self.assertEqual(self.sleeps,[(0.5, 1)] * 8)
+        self.assertEqual(recovered,[1] * 7) # Stopped during the last delay, so not restarted after it
+        self.assertEqual(self.returncode,3)
+        self.assertEqual(self.output().count('Starting keepalived'),8)
+        self.assertNotIn('terminating',self.output())
+
+    def test_without_a_restart_limit_the_exit_is_returned(self):
+        self.supervise(restart_limit=None)
+        self.assertEqual(self.returncode,3)
+        self.assertEqual(self.sleeps,[])
+        self.assertEqual(self.output().count('Starting keepalived'),1)
+
+    def test_restarts_while_master_are_dampened(self):
+        # Each exit is a flap of the master, and the configuration is rendered again before each restart
+        dampening = entry.FlapDampening(os.path.join(self.directory,'vrrp-state.json'),900,2000,750)
+        suppressed = []
+        self.uptime = 10
+        self.restarts = 4
+        self.supervise(dampening=dampening,restart_limit=5,restart_window=60,backoff=1,max_backoff=4,
+                       before_restart=lambda: suppressed.append(dampening.status()['web'][1]))
+        self.assertEqual(suppressed,[False, False, True])
+        self.assertEqual([state for _, state in dampening.records['web']['transitions']],
+                         ['MASTER', 'STOPPED'] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
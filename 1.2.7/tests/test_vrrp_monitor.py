@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Tests the VRRP advertisement decoder and monitor against the pcap captures in tests/fixtures. Run with:
+# python -m unittest discover -s tests
+import os
+import random
+import StringIO
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scripts'))
+import entry
+from vrrp_fixtures import advert, capture, fixtures, fixtures_path
+
+instances = [{ 'name' : 'web', 'track_iface' : 'eth0', 'virtual_router_id' : 51, 'auth_pass' : 'secret',
+               'virtual_ipaddresses' : [{ 'addr' : '10.1.0.1' }, { 'addr' : '2001:db8::1' }] }]
+
+def read_fixture(name):
+    with open(os.path.join(fixtures_path,name),'rb') as f:
+        return list(entry.read_pcap(f))
+
+class DecodeAdvertTest(unittest.TestCase):
+    def test_valid_advert(self):
+        self.assertEqual(entry.decode_advert(advert('192.0.2.20',51,90,['10.1.0.1','10.1.0.2'],advert_int=3)),
+                         ('192.0.2.20', 51, 90, 3, 1, 'secret\0\0', ('10.1.0.1', '10.1.0.2')))
+
+    def test_dropped_as_keepalived_would(self):
+        packet = advert('192.0.2.20',51,90,['10.1.0.1'])
+        self.assertEqual(entry.decode_advert(advert('192.0.2.20',51,90,['10.1.0.1'],ttl=64)),None)
+        self.assertEqual(entry.decode_advert(packet[:-1] + 'X'),None) # A bad checksum
+        self.assertEqual(entry.decode_advert(packet[:20] + '\x31' + packet[21:]),None) # VRRPv3
+        for length in range(len(packet)):
+            self.assertEqual(entry.decode_advert(packet[:length]),None)
+
+    def test_fuzzed_packets_do_not_raise(self):
+        rng = random.Random(1)
+        packet = advert('192.0.2.20',51,90,['10.1.0.1','10.1.0.2'])
+        for _ in range(20000):
+            fuzzed = bytearray(packet[:rng.randint(0,len(packet) + 8)].ljust(len(packet) + 8,'\0'))
+            for _ in range(rng.randint(1,4)):
+                fuzzed[rng.randrange(len(fuzzed))] = rng.randrange(256)
+            entry.decode_advert(str(fuzzed))
+
+class ReadPcapTest(unittest.TestCase):
+    def test_every_link_type_reads_the_same_packets(self):
+        for name, linktype, order, nanoseconds in fixtures:
+            packets = read_fixture(name)
+            self.assertEqual([packet for seconds, packet in packets],[packet for seconds, packet in capture],name)
+            for (seconds, _), (expected, _) in zip(packets,capture):
+                self.assertAlmostEqual(seconds,expected,6,name)
+
+    def test_not_a_capture(self):
+        self.assertRaises(ValueError,list,entry.read_pcap(StringIO.StringIO('\0' * 24)))
+        self.assertEqual(list(entry.read_pcap(StringIO.StringIO(''))),[])
+
+    def test_unsupported_link_type(self):
+        with open(os.path.join(fixtures_path,'vrrp-raw.pcap'),'rb') as f:
+            header = f.read(24)
+        self.assertRaises(ValueError,list,entry.read_pcap(StringIO.StringIO(header[:20] + '\x69\x00\x00\x00' +
+                                                                            '\0' * 16)))
+
+class VrrpMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        self.time = entry.time.time
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        entry.time.time = self.time
+
+    def replay(self,name):
+        monitor = entry.VrrpMonitor(instances,1,set(['192.0.2.10']))
+        for seconds, packet in read_fixture(name):
+            monitor.observe('eth0',packet,seconds)
+        return monitor
+
+    def test_peers_and_conflicts(self):
+        monitor = self.replay('vrrp-ethernet.pcap')
+        entry.time.time = lambda: 1006.0
+        peers, invalid = monitor.status()
+        self.assertEqual(invalid,3)
+        self.assertEqual([peer[:5] + peer[6:] for peer in peers],[
+            ('eth0', 51, '192.0.2.20', 90, 6, True, None),
+            ('eth0', 51, '192.0.2.30', 120, 1, False, 'a different password'),
+            ('eth0', 52, '192.0.2.40', 100, 1, True, None),
+        ])
+        output = sys.stdout.getvalue()
+        self.assertIn('Found the VRRP peer 192.0.2.20 on eth0 for instance web (VRID 51) with priority 90',output)
+        self.assertIn('WARNING: The VRRP router 192.0.2.30 on eth0 conflicts with instance web',output)
+        self.assertIn('Found a VRRP router 192.0.2.40 on eth0 for VRID 52 with priority 100',output)
+        self.assertNotIn('192.0.2.10',output)
+        self.assertEqual(monitor.listen(0),'1 VRRP routers conflict with the instances, see the warnings above')
+
+    def test_jitter(self):
+        jitter = 0.0
+        for gap in (1.05, 0.92, 1.05, 0.93, 1.06): # The times between the adverts of 192.0.2.20
+            jitter += (abs(gap - 1) - jitter) / 16
+        peers = self.replay('vrrp-ethernet.pcap').status()[0]
+        self.assertAlmostEqual(peers[0][5],jitter,5)
+
+    def test_every_link_type_gives_the_same_result(self):
+        entry.time.time = lambda: 1006.0
+        results = []
+        for name, linktype, order, nanoseconds in fixtures:
+            peers, invalid = self.replay(name).status()
+            results.append(([peer[:5] + (round(peer[5],6),) + peer[6:] for peer in peers], invalid))
+        self.assertEqual(results,[results[0]] * len(fixtures))
+
+    def test_conflicts_follow_the_expected_instances(self):
+        monitor = self.replay('vrrp-sll.pcap')
+        changed = [dict(instances[0], virtual_ipaddresses=[{ 'addr' : '10.1.0.9' }])]
+        monitor.expect(changed)
+        monitor.observe('eth0',advert('192.0.2.20',51,90,['10.1.0.1']),1006.0)
+        self.assertIn('uses VRID 51 with the addresses 10.1.0.1 rather than 10.1.0.9',sys.stdout.getvalue())
+        monitor.expect(instances)
+        monitor.observe('eth0',advert('192.0.2.20',51,90,['10.1.0.1'],advert_int=2),1007.0)
+        self.assertIn('with an advert interval of 2s rather than 1s',sys.stdout.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
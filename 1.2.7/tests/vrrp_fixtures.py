@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Builds VRRP advertisements and the pcap captures of them in tests/fixtures, so that the VRRP monitor can be tested
+# without a network. Run it to write the captures again: python tests/vrrp_fixtures.py
+import os
+import socket
+import struct
+
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+def checksum(data):
+    """Return the one's complement checksum of `data`, as IP and VRRP use."""
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def advert(source,vrid,priority,addresses,password='secret',advert_int=1,ttl=255,auth_type=1):
+    """Return the IPv4 packet of a VRRPv2 advertisement from `source`."""
+    vrrp = struct.pack('!BBBBBBH',0x21,vrid,priority,len(addresses),auth_type,advert_int,0)
+    vrrp += ''.join(socket.inet_aton(address) for address in addresses) + password[:8].ljust(8,'\0')
+    vrrp = vrrp[:6] + struct.pack('!H',checksum(vrrp)) + vrrp[8:]
+    ip = struct.pack('!BBHHHBBH4s4s',0x45,0xc0,20 + len(vrrp),0,0,ttl,112,0,socket.inet_aton(source),
+                     socket.inet_aton('224.0.0.18'))
+    return ip[:10] + struct.pack('!H',checksum(ip)) + ip[12:] + vrrp
+
+# The capture every fixture holds, as the seconds it was seen and the packet. web (VRID 51) has a peer on 192.0.2.20
+# whose adverts arrive up to 50ms early or late, a router on 192.0.2.30 with the wrong password, and this host's own
+# adverts from 192.0.2.10. 192.0.2.40 uses VRID 52, which no instance uses. Three packets are not valid adverts.
+capture = []
+for second, jitter in enumerate([0, 0.05, -0.03, 0.02, -0.05, 0.01]):
+    capture.append((1000 + second + jitter, advert('192.0.2.20',51,90,['10.1.0.1'])))
+    capture.append((1000.2 + second, advert('192.0.2.10',51,100,['10.1.0.1'])))
+capture += [
+    (1000.5, advert('192.0.2.30',51,120,['10.1.0.1'],password='wrong')),
+    (1002.5, advert('192.0.2.40',52,100,['10.2.0.1'],advert_int=2)),
+    (1003.5, advert('192.0.2.50',51,100,['10.1.0.1'],ttl=64)),                # Forwarded by a router
+    (1004.5, advert('192.0.2.50',51,100,['10.1.0.1'])[:-4] + 'XXXX'),         # A bad checksum
+    (1005.5, advert('192.0.2.50',51,100,['10.1.0.1','10.1.0.2'])[:-12]),      # Truncated
+]
+capture.sort()
+
+def frames(linktype):
+    """Return the capture framed for `linktype`. The Ethernet capture tags every other frame with a VLAN, and has an
+    ARP frame that is not IPv4."""
+    framed = []
+    for index, (seconds, packet) in enumerate(capture):
+        if linktype == 1:
+            header = '\x01\x00\x5e\x00\x00\x12' + '\x00\x00\x5e\x00\x01\x33'
+            if index % 2:
+                header += '\x81\x00\x00\x64'
+            framed.append((seconds, header + '\x08\x00' + packet))
+            if index == 3:
+                framed.append((seconds, '\xff' * 6 + '\x00\x00\x5e\x00\x01\x33' + '\x08\x06' + '\0' * 28))
+        elif linktype == 113:
+            framed.append((seconds, '\x00\x00\x00\x01\x00\x06\x00\x00\x5e\x00\x01\x33\x00\x00\x08\x00' + packet))
+        else:
+            framed.append((seconds, packet))
+    return framed
+
+def write_pcap(path,linktype,order='<',nanoseconds=False):
+    """Write the capture framed for `linktype` to the pcap file at `path`, in the byte `order` given."""
+    with open(path,'wb') as f:
+        f.write(struct.pack(order + 'IHHiIII',0xa1b23c4d if nanoseconds else 0xa1b2c3d4,2,4,0,0,65535,linktype))
+        for seconds, frame in frames(linktype):
+            fraction = int(round(seconds % 1 * (1e9 if nanoseconds else 1e6)))
+            f.write(struct.pack(order + 'IIII',int(seconds),fraction,len(frame),len(frame)) + frame)
+
+fixtures = [ # The file name, link type, byte order and whether the timestamps are in nanoseconds
+    ('vrrp-ethernet.pcap', 1, '<', False),
+    ('vrrp-sll.pcap', 113, '>', False),
+    ('vrrp-raw.pcap', 101, '<', True),
+]
+
+if __name__ == '__main__':
+    for name, linktype, order, nanoseconds in fixtures:
+        write_pcap(os.path.join(fixtures_path,name),linktype,order,nanoseconds)
+        print "Wrote %s" % os.path.join(fixtures_path,name)